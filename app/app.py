@@ -1,13 +1,29 @@
 import os
+import json
+import time
+import base64
+import asyncio
 import logging
+import threading
+import contextvars
+from functools import partial
+from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import gradio as gr
-from PIL import Image as PILImage
-
-from google.cloud import aiplatform, storage, bigquery
-from google.cloud.aiplatform import MatchingEngineIndex, MatchingEngineIndexEndpoint, matching_engine
-from vertexai.preview.vision_models import MultiModalEmbeddingModel, Image
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+from images import encode_query_image, encode_query_bytes
+from batcher import EmbeddingBatcher
+from embedding_client import EmbeddingClient
+from startup import Startup
+from tracing import Tracer, span, annotate, cache_lookup, record_error
+from cache import EmbeddingCache, ResultCache
+from vector_index import LocalVectorIndex, RemoteVectorIndex, Neighbor, Restrict
+from metadata import MetadataStore, BigQueryMetadataBackend, extract_author_title
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -25,10 +41,50 @@ ALL_PREFIX = os.getenv("ALL_PREFIX")
 DATA_BUCKET = os.getenv("DATA_BUCKET")
 DATASET = os.getenv("DATASET")
 TABLE = os.getenv("TABLE")
+PRELOAD_METADATA = os.getenv("PRELOAD_METADATA", "true").lower() == "true"
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", "10000"))
+METADATA_CACHE_TTL = int(os.getenv("METADATA_CACHE_TTL", "3600"))
+QUERY_IMAGE_SIZE = int(os.getenv("QUERY_IMAGE_SIZE", "1024"))
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "1000"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1000"))
+INDEX_VERSION_CHECK_INTERVAL = int(os.getenv("INDEX_VERSION_CHECK_INTERVAL", "300"))
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR")
+LOCAL_INDEX_MODE = os.getenv("LOCAL_INDEX_MODE", "exact")
+LOCAL_INDEX_PROBES = int(os.getenv("LOCAL_INDEX_PROBES", "8"))
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "16"))
+QUEUE_CONCURRENCY = int(os.getenv("QUEUE_CONCURRENCY", "8"))
+QUEUE_MAX_SIZE = int(os.getenv("QUEUE_MAX_SIZE", "64"))
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "0"))
+EMBEDDING_BATCH_MAX_ITEMS = int(os.getenv("EMBEDDING_BATCH_MAX_ITEMS", "16"))
+DEDUP_OVERFETCH = int(os.getenv("DEDUP_OVERFETCH", "2"))
+EMBEDDING_RATE_LIMIT = float(os.getenv("EMBEDDING_RATE_LIMIT", "0"))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "8"))
+EMBEDDING_RETRY_ATTEMPTS = int(os.getenv("EMBEDDING_RETRY_ATTEMPTS", "3"))
+EMBEDDING_RETRY_MAX_DELAY = float(os.getenv("EMBEDDING_RETRY_MAX_DELAY", "2"))
+BATCH_SEARCH_CHUNK_SIZE = int(os.getenv("BATCH_SEARCH_CHUNK_SIZE", "32"))
+BATCH_SEARCH_MAX_QUERIES = int(os.getenv("BATCH_SEARCH_MAX_QUERIES", "10000"))
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "1408"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+SEARCH_CANDIDATES = int(os.getenv("SEARCH_CANDIDATES", "200"))
+RESULT_PAGE_SIZE = int(os.getenv("RESULT_PAGE_SIZE", "10"))
+THUMBNAIL_PREFIX = os.getenv("THUMBNAIL_PREFIX", "")
+THUMBNAIL_FORMAT = os.getenv("THUMBNAIL_FORMAT", "webp")
+THUMBNAIL_BASE_URL = os.getenv("THUMBNAIL_BASE_URL", f"https://storage.cloud.google.com/{DATA_BUCKET}")
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+TRACE_LOG_JSON = os.getenv("TRACE_LOG_JSON", "false").lower() == "true"
+SERVER_PORT = int(os.getenv("SERVER_PORT", "7860"))
 
 multimodalembedding = None
 index = None
 index_endpoint = None
+metadata_resolver = None
+embedding_cache = None
+result_cache = None
+executor = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="search")
+embedding_batcher = None
+tracer = Tracer(enabled=TRACING_ENABLED, json_logs=TRACE_LOG_JSON)
+startup = Startup()
 
 
 def get_path(name, category):
@@ -39,18 +95,13 @@ def get_url(name, category):
     return f"https://storage.cloud.google.com/{DATA_BUCKET}/{get_path(name, category)}"
 
 
-def extract_author_title(image_id):
-    parts = image_id.split('_')
-    author = parts[0].replace('-', ' ')
-    title = '_'.join(parts[1:])
-    return author, title
+def get_thumbnail_url(name):
+    # The pipeline writes thumbnails under the datapoint id, so no genre is needed
+    return f"{THUMBNAIL_BASE_URL}/{THUMBNAIL_PREFIX}/{name}.{THUMBNAIL_FORMAT}"
 
 
-def format_genre(genre):
-    cleaned_string = genre.strip("[]").replace("'", "")
-    cleaned_string = cleaned_string.split(",")[0]
-    result = cleaned_string.lower().replace(" ", "-")
-    return result
+def get_display_url(name, category):
+    return get_thumbnail_url(name) if THUMBNAIL_PREFIX else get_url(name, category)
 
 
 def format_folder(genre):
@@ -59,103 +110,532 @@ def format_folder(genre):
     return result
 
 
-def download_from_gcs(image_uri, data_bucket):
-    try:
-        client = storage.Client()
-        bucket = client.bucket(data_bucket)
-        blob = bucket.blob(image_uri)
-        blob.download_to_filename(image_uri)
-    except Exception as ex:
-        logging.error(f"Error downloading {image_uri} from GCS: {ex}")
-
-
-def get_image_metadata(image_id):
-    try:
-        author, title = extract_author_title(image_id)
-        client = bigquery.Client(project=PROJECT_ID)
-        query = f"""
-        SELECT artist, genre, description
-        FROM `{PROJECT_ID}.{DATASET}.{TABLE}`
-        WHERE artist = @author AND description = @title
-        """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("author", "STRING", author),
-                bigquery.ScalarQueryParameter("title", "STRING", title)]
+def get_label(artist, description, genre):
+    return f"{artist.title()} - {description.replace('-', ' ').title()} - {genre.replace('-', ' ').title()}"
+
+
+def match_batch(query_embs, num_results, filter):
+    with span("match"):
+        return index_endpoint.match(
+            DEPLOYED_INDEX_ID,
+            queries=query_embs,
+            num_neighbors=num_results,
+            filter=[Restrict("category", filter, [])]
         )
 
-        query_job = client.query(query, job_config=job_config)
-        result = query_job.result(max_results=1)
 
-        for row in result:
-            return row.artist, row.description, format_genre(row.genre)
+def find_neighbors(query_emb, num_results, filter):
+    return match_batch([query_emb], num_results, filter)[0]
 
-        return "", "", ""
-    except Exception as ex:
-        logger.error(f"Error querying metadata for {image_id}: {ex}")
-        return "", "", ""
 
+def collapse_duplicates(rows, seen=None):
+    # Copies of a painting filed under several genres share the artist and title.
+    # Pages of one search pass the same seen set, so a painting shows up once across them.
+    seen = set() if seen is None else seen
+    for match, record in rows:
+        artist, description = record[:2]
+        key = (artist, description) if artist or description else match.id
+        if key not in seen:
+            seen.add(key)
+            yield match, record
 
-def get_label(artist, description, genre):
-    return f"{artist.title()} - {description.replace('-', ' ').title()} - {genre.replace('-', ' ').title()}"
 
+def resolve_matches(neighbors, collapse=False, num_results=None, seen=None):
+    with span("metadata"):
+        records = metadata_resolver.lookup([match.id for match in neighbors])
 
-def get_matches(query_emb, num_results, filter):
-    result = index_endpoint.match(
-        DEPLOYED_INDEX_ID,
-        queries=[query_emb],
-        num_neighbors=int(num_results),
-        filter=[matching_engine.matching_engine_index_endpoint.Namespace(
-            "category", filter, [])]
-    )
+    rows = zip(neighbors, records)
+    if collapse:
+        rows = list(collapse_duplicates(rows, seen))[:num_results]
 
     matches = []
-    for match in result[0]:
-        artist, description, genre = get_image_metadata(match.id)
-        
-        matches.append(
-            (get_url(match.id, genre), get_label(artist, description, genre))
-        )
+    for match, (artist, description, genre, url) in rows:
+        if not artist and not description:
+            # Unknown to the metadata store, the id still names the artist and the painting
+            artist, description = extract_author_title(match.id)
+        matches.append((url, get_label(artist, description, genre)))
+    return matches
+
+
+def cache_matches(query_emb, filter, num_results, matches, neighbors, collapse):
+    # A collapsed list that came up short only answers larger k if the index ran out of neighbors
+    if not collapse:
+        result_cache.put(query_emb, filter, num_results, matches)
+    elif len(matches) >= num_results or len(neighbors) < num_results * DEDUP_OVERFETCH:
+        result_cache.put(query_emb, filter, num_results, matches, variant="collapsed")
 
+
+def get_cached_matches(query_emb, num_results, filter, collapse):
+    annotate(num_results=num_results, filter_cardinality=len(filter), collapse=collapse)
+    matches = result_cache.get(query_emb, filter, num_results, variant="collapsed" if collapse else "")
+    cache_lookup("result", matches is not None)
+    if matches is not None:
+        annotate(results=len(matches))
     return matches
 
 
-def image_query(image_data, num_results, genres_filter):
-    if image_data is None:
-        raise gr.Error("Image cannot be empty")
-    
-    try:
-        image = PILImage.fromarray(np.uint8(image_data))
-        image_path = "image.jpg"
-        image.save(image_path)
-        query_image = Image.load_from_file(image_path)
-        query_emb = multimodalembedding.get_embeddings(
-            image=query_image).image_embedding
+async def run_blocking(fn, *args):
+    # SDK calls block, so they run on the bounded pool instead of the event loop.
+    # The context is copied so spans in fn attach to the caller's trace.
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, partial(context.run, fn, *args))
 
-        filter = [format_folder(genre) for genre in genres_filter]
-            
-        return get_matches(query_emb, num_results, filter)
 
-    except Exception as ex:
-        logger.error(f"Error: {ex}")
-        return []
+async def get_matches_async(query_emb, num_results, filter, collapse=False):
+    num_results = int(num_results)
+    matches = get_cached_matches(query_emb, num_results, filter, collapse)
+    if matches is not None:
+        return matches
+
+    neighbors = await run_blocking(find_neighbors, query_emb,
+                                   num_results * DEDUP_OVERFETCH if collapse else num_results, filter)
+    matches = await run_blocking(resolve_matches, neighbors, collapse, num_results)
+    cache_matches(query_emb, filter, num_results, matches, neighbors, collapse)
+    annotate(results=len(matches))
+    return matches
 
 
-def text_query(text, num_results, genres_filter):
-    if len(text) <= 0:
-        raise gr.Error("Query cannot be empty")
+def get_index_version():
+    if index is None:
+        return None
+    return index.update_time
+
+
+def watch_index_version():
+    # Invalidates cached results once update_index has pushed new embeddings.
+    while True:
+        try:
+            result_cache.set_version(get_index_version())
+        except Exception as ex:
+            logger.error(f"Error checking index version: {ex}")
+        time.sleep(INDEX_VERSION_CHECK_INTERVAL)
+
+
+def embed_image(image_array):
+    from vertexai.preview.vision_models import Image
+
+    with span("encode"):
+        query_image = Image(image_bytes=encode_query_image(image_array, QUERY_IMAGE_SIZE))
+    with span("embed"):
+        return multimodalembedding.get_embeddings(
+            image=query_image).image_embedding
+
 
-    try:
-        query_emb = multimodalembedding.get_embeddings(
+def embed_text(text):
+    with span("embed"):
+        return multimodalembedding.get_embeddings(
             contextual_text=text).text_embedding
 
-        filter = [format_folder(genre) for genre in genres_filter]
 
-        return get_matches(query_emb, num_results, filter)
+def embed_text_and_image(text, image):
+    # Batched calls run outside any request's context, the batcher's caller records the span.
+    # image is an array from the UI or the bytes of an uploaded file.
+    from vertexai.preview.vision_models import Image
+
+    query_image = None
+    if image is not None:
+        with span("encode"):
+            if isinstance(image, bytes):
+                query_image = Image(image_bytes=encode_query_bytes(image, QUERY_IMAGE_SIZE))
+            else:
+                query_image = Image(image_bytes=encode_query_image(image, QUERY_IMAGE_SIZE))
+    with span("embed"):
+        response = multimodalembedding.get_embeddings(image=query_image, contextual_text=text)
+    return response.text_embedding, response.image_embedding
+
+
+def image_cache_key(image_array):
+    return EmbeddingCache.image_key(str(image_array.shape).encode() + image_array.tobytes())
+
+
+def is_ready():
+    # Without startup tasks the globals were set up directly, as the benchmarks do
+    return not startup.tasks or startup.ready()
+
+
+def require_ready():
+    if not is_ready():
+        raise gr.Error("Search is still starting up, try again in a few seconds")
+
+
+def get_cached_embedding(cache_key):
+    query_emb = embedding_cache.get(cache_key)
+    cache_lookup("embedding", query_emb is not None)
+    return query_emb
+
+
+async def embed_text_async(text):
+    cache_key = EmbeddingCache.text_key(text)
+    query_emb = get_cached_embedding(cache_key)
+    if query_emb is None:
+        if embedding_batcher is not None:
+            with span("embed"):
+                query_emb = await embedding_batcher.embed_text(text)
+        else:
+            query_emb = await run_blocking(embed_text, text)
+        embedding_cache.put(cache_key, query_emb)
+    return query_emb
+
+
+async def embed_image_async(image_array):
+    cache_key = image_cache_key(image_array)
+    query_emb = get_cached_embedding(cache_key)
+    if query_emb is None:
+        if embedding_batcher is not None:
+            with span("embed"):
+                query_emb = await embedding_batcher.embed_image(image_array)
+        else:
+            query_emb = await run_blocking(embed_image, image_array)
+        embedding_cache.put(cache_key, query_emb)
+    return query_emb
+
+
+async def get_candidates_async(query_emb, num_results, filter, collapse):
+    # One index call fetches enough neighbors for the first results and the later pages
+    count = max(int(num_results), SEARCH_CANDIDATES) * (DEDUP_OVERFETCH if collapse else 1)
+    neighbors = result_cache.get(query_emb, filter, count, variant="candidates")
+    cache_lookup("result", neighbors is not None)
+    if neighbors is None:
+        neighbors = await run_blocking(find_neighbors, query_emb, count, filter)
+        result_cache.put(query_emb, filter, count, neighbors, variant="candidates")
+    return neighbors
+
+
+def next_page(session, count):
+    # Resolves metadata for the next count results of the session's candidates only.
+    # Collapsing drops copies, so each pass resolves a page's worth of overfetched ids
+    # and keeps what the page doesn't show for the next one.
+    neighbors = session["neighbors"]
+    while len(session["pending"]) < count and session["offset"] < len(neighbors):
+        size = count - len(session["pending"])
+        if session["collapse"]:
+            size = max(size, RESULT_PAGE_SIZE * DEDUP_OVERFETCH)
+        batch = neighbors[session["offset"]:session["offset"] + size]
+        resolved = resolve_matches(batch, session["collapse"], seen=session["seen"])
+        session["offset"] += len(batch)
+        # Results already shown from the result cache are resolved again only to rebuild seen
+        skipped = min(session["skip"], len(resolved))
+        session["skip"] -= skipped
+        session["pending"] += resolved[skipped:]
+    page, session["pending"] = session["pending"][:count], session["pending"][count:]
+    session["matches"] = session["matches"] + page
+    return page
+
+
+async def stream_pages(session, count):
+    # Yields the growing gallery a page at a time until count more results are shown
+    target = len(session["matches"]) + count
+    while len(session["matches"]) < target:
+        with tracer.trace("page"):
+            try:
+                page = await run_blocking(next_page, session,
+                                          min(RESULT_PAGE_SIZE, target - len(session["matches"])))
+                annotate(results=len(page))
+            except Exception as ex:
+                logger.error(f"Error: {ex}")
+                record_error(ex)
+                page = []
+        if not page:
+            return
+        yield session["matches"], session
+
+
+async def stream_results(kind, embed, num_results, genres_filter, collapse):
+    # The first page is shown as soon as its metadata is resolved, the rest follow page by page
+    num_results = int(num_results)
+    session = cached = None
+    with tracer.trace(kind):
+        try:
+            query_emb = await embed()
+
+            filter = [format_folder(genre) for genre in genres_filter]
+            annotate(num_results=num_results, filter_cardinality=len(filter), collapse=collapse)
+
+            neighbors = await get_candidates_async(query_emb, num_results, filter, collapse)
+            session = {"neighbors": neighbors, "offset": 0, "seen": set(), "collapse": collapse,
+                       "pending": [], "skip": 0, "matches": [], "page_size": num_results}
+            cached = get_cached_matches(query_emb, num_results, filter, collapse)
+            if cached is not None:
+                # A collapsed list doesn't map back to candidate offsets, so later pages skip past it
+                session["matches"] = cached
+                if collapse:
+                    session["skip"] = len(cached)
+                else:
+                    session["offset"] = len(cached)
+            else:
+                await run_blocking(next_page, session, min(num_results, RESULT_PAGE_SIZE))
+                annotate(results=len(session["matches"]))
+
+        except Exception as ex:
+            logger.error(f"Error: {ex}")
+            record_error(ex)
+
+    if session is None:
+        yield [], None
+        return
+    yield session["matches"], session
+    if cached is not None:
+        return
+    async for output in stream_pages(session, num_results - len(session["matches"])):
+        yield output
+    # Only a complete first view is cached, not one cut short by an error
+    exhausted = not session["pending"] and session["offset"] >= len(session["neighbors"])
+    if len(session["matches"]) >= num_results or exhausted:
+        cache_matches(query_emb, filter, num_results, session["matches"], session["neighbors"], collapse)
+
+
+async def image_query_stream(image_data, num_results, genres_filter, collapse=False):
+    if image_data is None:
+        raise gr.Error("Image cannot be empty")
+    require_ready()
+
+    image_array = np.uint8(image_data)
+    async for output in stream_results("image", lambda: embed_image_async(image_array),
+                                       num_results, genres_filter, collapse):
+        yield output
+
+
+async def text_query_stream(text, num_results, genres_filter, collapse=False):
+    if len(text) <= 0:
+        raise gr.Error("Query cannot be empty")
+    require_ready()
+
+    async for output in stream_results("text", lambda: embed_text_async(text),
+                                       num_results, genres_filter, collapse):
+        yield output
+
+
+async def load_more(session):
+    # Later pages come from the candidates cached in the session, without embedding or matching again
+    if not session:
+        raise gr.Error("Search first, then load more results")
+    if not session["pending"] and session["offset"] >= len(session["neighbors"]):
+        gr.Info("No more results")
+        yield session["matches"], session
+        return
+    async for output in stream_pages(session, session["page_size"]):
+        yield output
+
+
+def get_dimensions():
+    # The local index knows its dimensions, the remote one is assumed to match the model
+    return getattr(index_endpoint, "dimensions", None) or EMBEDDING_DIMENSIONS
+
+
+def embed_queries(queries):
+    # Returns the embeddings of a batch of queries and the error of each query that has none
+    embeddings = [None] * len(queries)
+    errors = [None] * len(queries)
+    texts, images = [], []
+    for i, query in enumerate(queries):
+        try:
+            if query.get("embedding") is not None:
+                # A wrong length would fail the multi-query match of the whole chunk
+                query_emb = [float(value) for value in query["embedding"]]
+                if len(query_emb) != get_dimensions():
+                    raise ValueError(f"embedding has {len(query_emb)} dimensions, expected {get_dimensions()}")
+                embeddings[i] = query_emb
+            elif query.get("text"):
+                texts.append((i, EmbeddingCache.text_key(query["text"]), query["text"]))
+            elif query.get("image") is not None:
+                data = query["image"]
+                if isinstance(data, str):
+                    data = base64.b64decode(data, validate=True)
+                images.append((i, EmbeddingCache.image_key(data), data))
+            else:
+                errors[i] = "Query needs a text, an image or an embedding"
+        except Exception as ex:
+            errors[i] = f"Invalid query: {ex}"
+
+    texts = [item for item in texts if not cached_into(item, embeddings)]
+    images = [item for item in images if not cached_into(item, embeddings)]
+
+    # Images are decoded before pairing, so a broken file doesn't fail the text it would share a call with
+    with span("encode"):
+        futures = [executor.submit(encode_query_bytes, data, QUERY_IMAGE_SIZE) for _, _, data in images]
+        encoded = []
+        for (i, cache_key, _), future in zip(images, futures):
+            try:
+                encoded.append((i, cache_key, future.result()))
+            except Exception as ex:
+                errors[i] = f"Invalid image: {ex}"
+        images = encoded
+
+    # The model embeds one text and one image per call, so pairs share a call as in the batcher
+    pairs = list(zip_longest(texts, images))
+    futures = [executor.submit(embed_text_and_image,
+                               text_item[2] if text_item else None,
+                               image_item[2] if image_item else None)
+               for text_item, image_item in pairs]
+    for (text_item, image_item), future in zip(pairs, futures):
+        try:
+            response = future.result()
+        except Exception as ex:
+            logger.error(f"Error embedding batch queries: {ex}")
+            for item in (text_item, image_item):
+                if item is not None:
+                    errors[item[0]] = f"Error embedding query: {ex}"
+            continue
+        for item, query_emb in zip((text_item, image_item), response):
+            if item is not None:
+                embeddings[item[0]] = query_emb
+                embedding_cache.put(item[1], query_emb)
+    return embeddings, errors
+
+
+def cached_into(item, embeddings):
+    query_emb = get_cached_embedding(item[1])
+    if query_emb is not None:
+        embeddings[item[0]] = query_emb
+    return query_emb is not None
+
+
+def format_result(match, artist, description, genre):
+    result = {"id": match.id, "distance": match.distance, "artist": artist,
+              "title": description, "genre": genre, "url": get_url(match.id, genre)}
+    if THUMBNAIL_PREFIX:
+        result["thumbnail"] = get_thumbnail_url(match.id)
+    return result
+
 
-    except Exception as ex:
-        logger.error(f"Error: {ex}")
-        return []
+def search_chunk(queries, num_results, filter, collapse):
+    with span("embed"):
+        embeddings, errors = embed_queries(queries)
+
+    # One multi-query match and one metadata lookup for the whole chunk
+    valid = [i for i, query_emb in enumerate(embeddings) if query_emb is not None]
+    neighbors = {}
+    num_neighbors = num_results * DEDUP_OVERFETCH if collapse else num_results
+    if valid:
+        try:
+            neighbors = dict(zip(valid, match_batch([embeddings[i] for i in valid], num_neighbors, filter)))
+        except Exception as ex:
+            # One bad query fails the whole call, so each query is retried alone
+            logger.error(f"Error matching batch queries, retrying one at a time: {ex}")
+            for i in valid:
+                try:
+                    neighbors[i] = find_neighbors(embeddings[i], num_neighbors, filter)
+                except Exception as ex:
+                    errors[i] = f"Error matching query: {ex}"
+
+    ids = [match.id for i in neighbors for match in neighbors[i]]
+    metadata = {}
+    if ids:
+        with span("metadata"):
+            metadata = dict(zip(ids, metadata_resolver.resolve(ids)))
+
+    results = []
+    for i in range(len(queries)):
+        if i not in neighbors:
+            results.append({"error": errors[i]})
+            continue
+        rows = [(match, metadata[match.id]) for match in neighbors[i]]
+        if collapse:
+            rows = list(collapse_duplicates(rows))[:num_results]
+        results.append({"results": [format_result(match, *row) for match, row in rows]})
+    return results
+
+
+def search_batch(queries, num_results=20, genres=(), collapse=False, chunk_size=None):
+    """Searches with a list of queries, each a dict with a "text", an "image" (bytes, or
+    base64 in JSON) or an "embedding", and an optional "id". Yields one dict per query,
+    in order, with its id and either its results or an error."""
+    num_results = int(num_results)
+    chunk_size = chunk_size or BATCH_SEARCH_CHUNK_SIZE
+    filter = [format_folder(genre) for genre in genres]
+    for start in range(0, len(queries), chunk_size):
+        chunk = queries[start:start + chunk_size]
+        with tracer.trace("batch"):
+            annotate(queries=len(chunk), num_results=num_results,
+                     filter_cardinality=len(filter), collapse=collapse)
+            results = search_chunk(chunk, num_results, filter, collapse)
+            annotate(results=sum(len(result.get("results", [])) for result in results))
+        for i, (query, result) in enumerate(zip(chunk, results)):
+            yield {"id": query.get("id", start + i), **result}
+
+
+def query_weights(has_text, num_images, text_weight):
+    # The text gets text_weight, the reference images share the rest equally
+    if not num_images:
+        return [1.0]
+    if not has_text:
+        return [1.0 / num_images] * num_images
+    return [text_weight] + [(1.0 - text_weight) / num_images] * num_images
+
+
+def fuse_embeddings(embeddings, weights):
+    # Text and image embeddings share one space, so a weighted mean of the
+    # normalized vectors is a single query that sits between them
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    fused = np.average(vectors, axis=0, weights=weights)
+    return (fused / max(np.linalg.norm(fused), 1e-12)).tolist()
+
+
+def reciprocal_rank_fusion(neighbor_lists, weights, k=RRF_K):
+    # Returns the union of the neighbor lists ranked by their weighted reciprocal
+    # ranks, each image once, with the fused score as its distance
+    scores = {}
+    for neighbors, weight in zip(neighbor_lists, weights):
+        for rank, match in enumerate(neighbors):
+            scores[match.id] = scores.get(match.id, 0.0) + weight / (k + rank + 1)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [Neighbor(image_id, scores[image_id]) for image_id in ranked]
+
+
+def embed_hybrid(text, image_paths):
+    queries = ([{"text": text}] if text else []) + [{"image": read_file(path)} for path in image_paths]
+    return embed_queries(queries)
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def rrf_matches(embeddings, weights, num_results, filter, collapse):
+    # One multi-query match for all vectors, one metadata lookup for the fused list
+    num_neighbors = num_results * DEDUP_OVERFETCH if collapse else num_results
+    fused = reciprocal_rank_fusion(match_batch(embeddings, num_neighbors, filter), weights)
+    return resolve_matches(fused[:num_neighbors], collapse, num_results)
+
+
+async def hybrid_query_async(text, image_paths, num_results, genres_filter, collapse=False,
+                             fusion="Average", text_weight=0.5):
+    image_paths = image_paths or []
+    if not text and not image_paths:
+        raise gr.Error("Enter a text query or add reference images")
+    require_ready()
+
+    with tracer.trace("hybrid"):
+        try:
+            # embed_queries waits on the search pool itself, so it runs on a thread outside it
+            embeddings, errors = await asyncio.to_thread(embed_hybrid, text, image_paths)
+        except Exception as ex:
+            logger.error(f"Error: {ex}")
+            record_error(ex)
+            return []
+        error = next((error for error in errors if error), None)
+        if error:
+            record_error(error)
+            raise gr.Error(error)
+
+        try:
+            filter = [format_folder(genre) for genre in genres_filter]
+            weights = query_weights(bool(text), len(image_paths), float(text_weight))
+            annotate(vectors=len(embeddings), fusion=fusion)
+
+            if fusion == "Reciprocal rank" and len(embeddings) > 1:
+                matches = await run_blocking(rrf_matches, embeddings, weights, int(num_results), filter, collapse)
+                annotate(results=len(matches), filter_cardinality=len(filter))
+                return matches
+            return await get_matches_async(fuse_embeddings(embeddings, weights), num_results, filter, collapse)
+
+        except Exception as ex:
+            logger.error(f"Error: {ex}")
+            record_error(ex)
+            return []
 
 
 def create_ui():
@@ -205,6 +685,8 @@ def create_ui():
                                         label="Number of results",
                                         value=20,
                                         info="How many results to show.")
+                collapse = gr.Checkbox(label="Hide duplicates", value=False,
+                                       info="Show each painting once.")
                 clear = gr.ClearButton(value="Clear input", components=[image, genres_filter])
                 find_by_image_btn = gr.Button("Get images", variant="primary", icon="icon_search.svg")
 
@@ -212,8 +694,11 @@ def create_ui():
                                 show_label=True,
                                 columns=[5],
                                 object_fit="cover")
+            session = gr.State(None)
+            load_more_btn = gr.Button("Load more")
 
-            find_by_image_btn.click(image_query, inputs=[image, num_results, genres_filter], outputs=[images])
+            find_by_image_btn.click(image_query_stream, inputs=[image, num_results, genres_filter, collapse], outputs=[images, session])
+            load_more_btn.click(load_more, inputs=[session], outputs=[images, session])
 
 
         with gr.Tab("Text-to-image search"):
@@ -227,6 +712,8 @@ def create_ui():
                                         label="Number of results",
                                         value=20,
                                         info="How many results to show.")
+                collapse = gr.Checkbox(label="Hide duplicates", value=False,
+                                       info="Show each painting once.")
                 clear = gr.ClearButton(value="Clear input", components=[text, genres_filter])
                 find_by_text_btn = gr.Button("Get images", variant="primary", icon="icon_search.svg")
 
@@ -234,27 +721,190 @@ def create_ui():
                                 show_label=True,
                                 columns=[5],
                                 object_fit="cover")
+            session = gr.State(None)
+            load_more_btn = gr.Button("Load more")
         
-            find_by_text_btn.click(text_query, inputs=[text, num_results, genres_filter], outputs=[images])
+            find_by_text_btn.click(text_query_stream, inputs=[text, num_results, genres_filter, collapse], outputs=[images, session])
+            load_more_btn.click(load_more, inputs=[session], outputs=[images, session])
+
+
+        with gr.Tab("Hybrid search"):
+            text = gr.Textbox(label="Text query", info="Optional. Describes what to change or look for.")
+            reference_images = gr.File(label="Reference images",
+                                       file_count="multiple",
+                                       file_types=["image"],
+                                       type="filepath")
+            genres_filter = gr.CheckboxGroup(genres,
+                                            label="Genres",
+                                            info="Optional. Select genres to filter.")
+
+            with gr.Row():
+                fusion = gr.Radio(["Average", "Reciprocal rank"],
+                                  label="Fusion",
+                                  value="Average",
+                                  info="Average the query vectors, or merge the results of each one.")
+                text_weight = gr.Slider(0, 1, value=0.5, step=0.05,
+                                        label="Text weight",
+                                        info="Share of the text against the images.")
+
+            with gr.Row():
+                num_results = gr.Dropdown([5, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100], 
+                                        label="Number of results",
+                                        value=20,
+                                        info="How many results to show.")
+                collapse = gr.Checkbox(label="Hide duplicates", value=False,
+                                       info="Show each painting once.")
+                clear = gr.ClearButton(value="Clear input", components=[text, reference_images, genres_filter])
+                find_by_hybrid_btn = gr.Button("Get images", variant="primary", icon="icon_search.svg")
+
+            images = gr.Gallery(label="Images",
+                                show_label=True,
+                                columns=[5],
+                                object_fit="cover")
+
+            find_by_hybrid_btn.click(hybrid_query_async,
+                                     inputs=[text, reference_images, num_results, genres_filter, collapse, fusion, text_weight],
+                                     outputs=[images])
 
     return iface
 
 
-if __name__ == '__main__':
+def create_server(ui):
+    # Gradio is mounted on a plain FastAPI app so operational endpoints can sit next to it
+    server = FastAPI()
+
+    @server.get("/metrics", response_class=PlainTextResponse)
+    def metrics():
+        return tracer.metrics.render()
+
+    @server.get("/healthz")
+    def healthz():
+        # Live unless a critical startup task failed, then the replica should be replaced
+        status = startup.status()
+        return JSONResponse(status, status_code=503 if status["failed"] else 200)
+
+    @server.get("/readyz")
+    def readyz():
+        status = startup.status()
+        return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+    @server.post("/api/search")
+    async def batch_search(request: Request):
+        # Body: {"queries": [...], "num_results": 20, "genres": [], "collapse": false},
+        # results are streamed back as one JSON line per query
+        if not is_ready():
+            return JSONResponse(startup.status(), status_code=503)
+        try:
+            body = await request.json()
+            queries = body["queries"]
+            if not isinstance(queries, list) or not all(isinstance(query, dict) for query in queries):
+                raise ValueError("queries must be a list of objects")
+            if len(queries) > BATCH_SEARCH_MAX_QUERIES:
+                raise ValueError(f"At most {BATCH_SEARCH_MAX_QUERIES} queries per request")
+            num_results = int(body.get("num_results", 20))
+            if num_results < 1:
+                raise ValueError("num_results must be positive")
+            genres = body.get("genres", [])
+            if not isinstance(genres, list) or not all(isinstance(genre, str) for genre in genres):
+                raise ValueError("genres must be a list of strings")
+            results = search_batch(queries,
+                                   num_results=num_results,
+                                   genres=genres,
+                                   collapse=bool(body.get("collapse", False)))
+        except Exception as ex:
+            return JSONResponse({"error": f"Invalid request: {ex}"}, status_code=400)
+
+        return StreamingResponse((json.dumps(result) + "\n" for result in results),
+                                 media_type="application/x-ndjson")
+
+    return gr.mount_gradio_app(server, ui, path="/")
+
+
+def init_vertex():
+    from google.cloud import aiplatform
+
     aiplatform.init(project=PROJECT_ID, location=LOCATION)
     logger.info(f"Initialized AI Platform for project {PROJECT_ID}")
 
-    multimodalembedding = MultiModalEmbeddingModel.from_pretrained("multimodalembedding@001")
 
-    try:
-        index = aiplatform.MatchingEngineIndex(index_name=INDEX_ID)
-        index_endpoint = aiplatform.MatchingEngineIndexEndpoint(
-            index_endpoint_name=INDEX_ENDPOINT_ID
-        )
-    except Exception as ex:
-        logger.error(f"Could not get Vertex AI Endpoint: {ex}")
+def load_model():
+    global multimodalembedding
+    from vertexai.preview.vision_models import MultiModalEmbeddingModel
+
+    # A search waits on the embedding, so it gets a few seconds of retries, not the batch job's minute
+    multimodalembedding = EmbeddingClient(MultiModalEmbeddingModel.from_pretrained("multimodalembedding@001"),
+                                          rate=EMBEDDING_RATE_LIMIT,
+                                          max_concurrency=EMBEDDING_MAX_CONCURRENCY,
+                                          attempts=EMBEDDING_RETRY_ATTEMPTS,
+                                          max_delay=EMBEDDING_RETRY_MAX_DELAY)
+    tracer.metrics.add_gauges("search_embedding_client", multimodalembedding.stats)
+
+
+def load_index():
+    global index, index_endpoint
+
+    if LOCAL_INDEX_DIR:
+        index_endpoint = LocalVectorIndex(LOCAL_INDEX_DIR, mode=LOCAL_INDEX_MODE, num_probes=LOCAL_INDEX_PROBES)
+        logger.info(f"Serving {len(index_endpoint)} embeddings from local index {LOCAL_INDEX_DIR}")
+        return
+
+    from google.cloud import aiplatform
+
+    index = aiplatform.MatchingEngineIndex(index_name=INDEX_ID)
+    index_endpoint = RemoteVectorIndex(aiplatform.MatchingEngineIndexEndpoint(
+        index_endpoint_name=INDEX_ENDPOINT_ID
+    ))
+    threading.Thread(target=watch_index_version, daemon=True).start()
+
+
+def load_metadata():
+    global metadata_resolver
+
+    resolver = MetadataStore(BigQueryMetadataBackend(PROJECT_ID, DATASET, TABLE),
+                             max_cache_entries=METADATA_CACHE_SIZE,
+                             ttl_seconds=METADATA_CACHE_TTL,
+                             url_fn=get_display_url)
+    if PRELOAD_METADATA:
+        try:
+            resolver.load()
+        except Exception as ex:
+            logger.error(f"Could not preload metadata, falling back to BigQuery lookups: {ex}")
+    metadata_resolver = resolver
+    result_cache.add_invalidation_hook(metadata_resolver.invalidate)
+    tracer.metrics.add_gauges("search_metadata", metadata_resolver.stats)
+
+
+def load_embedding_cache():
+    global embedding_cache
+
+    embedding_cache = EmbeddingCache(max_entries=EMBEDDING_CACHE_SIZE, disk_path=EMBEDDING_CACHE_PATH)
+    if EMBEDDING_CACHE_PATH:
+        logger.info(f"Embedding cache persisted to {EMBEDDING_CACHE_PATH}: {embedding_cache.stats()}")
+    tracer.metrics.add_gauges("search_embedding_cache", embedding_cache.stats)
+
+
+if __name__ == '__main__':
+    result_cache = ResultCache(max_entries=RESULT_CACHE_SIZE)
+    tracer.metrics.add_gauges("search_result_cache", result_cache.stats)
+    if EMBEDDING_BATCH_WINDOW_MS > 0:
+        embedding_batcher = EmbeddingBatcher(embed_text_and_image,
+                                             executor=executor,
+                                             window_ms=EMBEDDING_BATCH_WINDOW_MS,
+                                             max_items=EMBEDDING_BATCH_MAX_ITEMS)
+        tracer.metrics.add_gauges("search_embedding_batcher", embedding_batcher.stats)
+
+    # The SDKs are imported and the clients resolved in the background, while the UI
+    # is built and the server starts, so /healthz answers within the first seconds.
+    startup.add("vertex", init_vertex)
+    startup.add("model", load_model, requires=["vertex"])
+    startup.add("index", load_index, requires=[] if LOCAL_INDEX_DIR else ["vertex"])
+    startup.add("metadata", load_metadata)
+    startup.add("embedding_cache", load_embedding_cache)
+    startup.start()
+
+    if TRACING_ENABLED:
+        logger.info(f"Tracing search requests, metrics at :{SERVER_PORT}/metrics")
 
     ui = create_ui()
-    ui.launch(inline=False,
-              server_name="0.0.0.0",
-              server_port=7860)
\ No newline at end of file
+    ui.queue(default_concurrency_limit=QUEUE_CONCURRENCY, max_size=QUEUE_MAX_SIZE)
+    uvicorn.run(create_server(ui), host="0.0.0.0", port=SERVER_PORT)
@@ -0,0 +1,99 @@
+import time
+import asyncio
+import logging
+from itertools import zip_longest
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingBatcher:
+    def __init__(self, embed_fn, executor=None, window_ms=10, max_items=16):
+        # embed_fn(text, image) embeds at most one text and one image in a
+        # single model request and returns (text_embedding, image_embedding).
+        self.embed_fn = embed_fn
+        self.executor = executor
+        self.window = window_ms / 1000
+        self.max_items = max_items
+
+        self._pending = []
+        self._timer = None
+        self._in_flight = 0
+
+        self.batches = 0
+        self.items = 0
+        self.api_calls = 0
+        self.total_queue_delay = 0.0
+        self.max_queue_delay = 0.0
+
+    async def embed_text(self, text):
+        return await self._submit("text", text)
+
+    async def embed_image(self, image):
+        return await self._submit("image", image)
+
+    async def _submit(self, kind, value):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((kind, value, future, time.perf_counter()))
+
+        # An idle batcher dispatches right away, so a single user never waits
+        # for the window; requests only queue up while others are in flight.
+        if self._in_flight == 0 or len(self._pending) >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        now = time.perf_counter()
+        for _, _, _, queued_at in batch:
+            delay = now - queued_at
+            self.total_queue_delay += delay
+            self.max_queue_delay = max(self.max_queue_delay, delay)
+        self.batches += 1
+        self.items += len(batch)
+
+        texts = [item for item in batch if item[0] == "text"]
+        images = [item for item in batch if item[0] == "image"]
+        # The model embeds one text and one image per request, so pairs share a call.
+        for text_item, image_item in zip_longest(texts, images):
+            self._dispatch(text_item, image_item)
+
+    def _dispatch(self, text_item, image_item):
+        loop = asyncio.get_running_loop()
+        self._in_flight += 1
+        self.api_calls += 1
+        call = loop.run_in_executor(self.executor, self.embed_fn,
+                                    text_item[1] if text_item else None,
+                                    image_item[1] if image_item else None)
+
+        def fan_out(call):
+            self._in_flight -= 1
+            for item, position in [(text_item, 0), (image_item, 1)]:
+                if item is None or item[2].done():
+                    continue
+                if call.exception() is not None:
+                    item[2].set_exception(call.exception())
+                else:
+                    item[2].set_result(call.result()[position])
+
+        call.add_done_callback(fan_out)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "api_calls": self.api_calls,
+            "in_flight": self._in_flight,
+            "pending": len(self._pending),
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+            "mean_queue_delay_ms": 1000 * self.total_queue_delay / self.items if self.items else 0.0,
+            "max_queue_delay_ms": 1000 * self.max_queue_delay,
+        }
@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPELINE_DIR = os.path.join(os.path.dirname(APP_DIR), "pipeline", "components", "generate_embeddings")
+sys.path.insert(0, APP_DIR)
+# The fake embedding model lives with the pipeline benchmarks
+sys.path.append(os.path.join(PIPELINE_DIR, "benchmarks"))
+
+import app
+from embedding_client import EmbeddingClient
+from fake_embedding_model import FakeEmbeddingModel
+from cache import EmbeddingCache, ResultCache
+from load_test import StubIndex, StubMetadata
+
+
+def reset(args):
+    app.multimodalembedding = EmbeddingClient(FakeEmbeddingModel(args.embed_ms), max_concurrency=app.WORKER_THREADS)
+    app.index_endpoint = StubIndex(args.match_ms)
+    app.metadata_resolver = StubMetadata(args.metadata_ms)
+    app.embedding_cache = EmbeddingCache(max_entries=0)
+    app.result_cache = ResultCache(max_entries=0)
+
+
+async def one_at_a_time(queries, num_results):
+    for query in queries:
+        async for _ in app.text_query_stream(query["text"], num_results, []):
+            pass
+
+
+def batched(queries, num_results, chunk_size):
+    for _ in app.search_batch(queries, num_results, chunk_size=chunk_size):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_queries', type=int, default=256, help='Text queries per run.')
+    parser.add_argument('--num_results', type=int, default=20, help='Results per query.')
+    parser.add_argument('--chunk_sizes', type=int, nargs='+', default=[8, 32, 128], help='Batch chunk sizes.')
+    parser.add_argument('--embed_ms', type=float, default=50.0, help='Simulated embedding latency.')
+    parser.add_argument('--match_ms', type=float, default=20.0, help='Simulated match latency per call.')
+    parser.add_argument('--metadata_ms', type=float, default=20.0, help='Simulated metadata latency per call.')
+    args = parser.parse_args()
+
+    queries = [{"text": f"query {i}"} for i in range(args.num_queries)]
+    runs = [("one at a time", lambda: asyncio.run(one_at_a_time(queries, args.num_results)))]
+    runs += [(f"batch of {size}", lambda size=size: batched(queries, args.num_results, size))
+             for size in args.chunk_sizes]
+
+    print(f"{'mode':>14} {'queries/sec':>12} {'match calls':>12}")
+    for name, run in runs:
+        reset(args)
+        calls = []
+        match = app.index_endpoint.match
+        app.index_endpoint.match = lambda *a, **k: calls.append(1) or match(*a, **k)
+        start = time.perf_counter()
+        run()
+        print(f"{name:>14} {args.num_queries / (time.perf_counter() - start):>12.1f} {len(calls):>12}")
@@ -0,0 +1,56 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+import statistics
+
+import numpy as np
+from PIL import Image as PILImage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from images import encode_query_image
+
+
+def encode_via_disk(image_array, directory):
+    # The previous path: save a full-size JPEG to disk and read it back.
+    image_path = os.path.join(directory, "image.jpg")
+    PILImage.fromarray(image_array).save(image_path)
+    with open(image_path, "rb") as f:
+        return f.read()
+
+
+def measure(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(timings), peak / 2 ** 20
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=10, help='Repeats per image size.')
+    parser.add_argument('--max_size', type=int, default=1024, help='Longest side after downscaling.')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'size':>10} {'path':>8} {'ms':>8} {'peak MiB':>9} {'bytes':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        for width, height in [(640, 480), (1600, 1200), (4000, 3000)]:
+            # Smooth gradients plus noise compress roughly like photographs.
+            gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+            image_array = np.uint8(np.clip(gradient + rng.normal(0, 20, (height, width, 3)), 0, 255))
+
+            for name, fn in [("disk", lambda: encode_via_disk(image_array, directory)),
+                             ("memory", lambda: encode_query_image(image_array, args.max_size))]:
+                elapsed, peak = measure(fn, args.repeats)
+                print(f"{width}x{height:<5} {name:>8} {elapsed:>8.1f} {peak:>9.1f} {len(fn()):>9}")
@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPELINE_DIR = os.path.join(os.path.dirname(APP_DIR), "pipeline", "components", "generate_embeddings")
+sys.path.insert(0, APP_DIR)
+# The fake embedding model lives with the pipeline benchmarks
+sys.path.append(os.path.join(PIPELINE_DIR, "benchmarks"))
+
+import app
+from batcher import EmbeddingBatcher
+from embedding_client import EmbeddingClient
+from fake_embedding_model import FakeEmbeddingModel
+from cache import EmbeddingCache, ResultCache
+from vector_index import Neighbor
+from metadata import BatchMetadataResolver
+
+
+class StubIndex:
+    def __init__(self, latency_ms):
+        self.latency = latency_ms / 1000
+
+    def match(self, deployed_index_id, queries, num_neighbors=1, filter=None, **kwargs):
+        time.sleep(self.latency)
+        return [[Neighbor(f"artist-{i}_painting-{i}", 1.0) for i in range(num_neighbors)] for _ in queries]
+
+
+class StubMetadata(BatchMetadataResolver):
+    def __init__(self, latency_ms):
+        super().__init__(None, url_fn=app.get_display_url)
+        self.latency = latency_ms / 1000
+
+    def resolve(self, image_ids):
+        time.sleep(self.latency)
+        return [("artist", "painting", "impressionism") for _ in image_ids]
+
+
+async def drain(results):
+    # The handlers stream pages, a request is done once the last one is shown
+    async for _ in results:
+        pass
+
+
+async def run_level(concurrency, num_requests, num_results, image_every, batch_window_ms):
+    latencies = []
+    counter = iter(range(num_requests))
+    image = np.zeros((64, 64, 3), dtype=np.uint8)
+    if batch_window_ms > 0:
+        app.embedding_batcher = EmbeddingBatcher(app.embed_text_and_image, executor=app.executor,
+                                                 window_ms=batch_window_ms)
+
+    async def worker():
+        for i in counter:
+            start = time.perf_counter()
+            if image_every and i % image_every == 0:
+                image[0, 0, 0] = i % 256
+                await drain(app.image_query_stream(image.copy(), num_results, []))
+            else:
+                await drain(app.text_query_stream(f"query {i}", num_results, []))
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    batcher_stats = app.embedding_batcher.stats() if app.embedding_batcher else None
+    return num_requests / elapsed, p50, p95, p99, batcher_stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=app.WORKER_THREADS, help='Size of the blocking-call pool.')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per concurrency level.')
+    parser.add_argument('--num_results', type=int, default=20, help='Results per request.')
+    parser.add_argument('--embed_ms', type=float, default=80.0, help='Stubbed get_embeddings latency.')
+    parser.add_argument('--match_ms', type=float, default=20.0, help='Stubbed index match latency.')
+    parser.add_argument('--metadata_ms', type=float, default=10.0, help='Stubbed metadata latency.')
+    parser.add_argument('--image_every', type=int, default=0, help='Send every n-th request as an image query.')
+    parser.add_argument('--embed_quota', type=float, default=0.0, help='Fake model quota in requests/sec, 0 for none.')
+    parser.add_argument('--batch_window_ms', type=float, default=0.0, help='Micro-batching window, 0 disables it.')
+    args = parser.parse_args()
+
+    app.executor = ThreadPoolExecutor(max_workers=args.workers)
+    app.multimodalembedding = EmbeddingClient(FakeEmbeddingModel(args.embed_ms, quota_per_sec=args.embed_quota),
+                                              rate=args.embed_quota,
+                                              max_concurrency=app.EMBEDDING_MAX_CONCURRENCY)
+    app.index_endpoint = StubIndex(args.match_ms)
+    app.metadata_resolver = StubMetadata(args.metadata_ms)
+    app.embedding_cache = EmbeddingCache(max_entries=0)
+    app.result_cache = ResultCache(max_entries=0)
+
+    print(f"{'concurrency':>11} {'qps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'batch':>6} {'api calls':>9}")
+    for concurrency in [1, 2, 4, 8, 16, 32, 64]:
+        qps, p50, p95, p99, batcher_stats = asyncio.run(run_level(
+            concurrency, args.requests, args.num_results, args.image_every, args.batch_window_ms))
+        batch_size = f"{batcher_stats['mean_batch_size']:.1f}" if batcher_stats else "-"
+        api_calls = batcher_stats['api_calls'] if batcher_stats else args.requests
+        print(f"{concurrency:>11} {qps:>8.1f} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f} {batch_size:>6} {api_calls:>9}")
+    print(f"Embedding client: {app.multimodalembedding.stats()}")
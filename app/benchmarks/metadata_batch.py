@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metadata import BatchMetadataResolver, SQLiteMetadataBackend
+
+
+class LatencyBackend:
+    # Adds a fixed round trip per query to mimic the per-job overhead of BigQuery.
+    def __init__(self, backend, round_trip_ms):
+        self.backend = backend
+        self.round_trip = round_trip_ms / 1000
+
+    def fetch_many(self, keys):
+        time.sleep(self.round_trip)
+        return self.backend.fetch_many(keys)
+
+
+def build_database(num_rows):
+    connection = sqlite3.connect(":memory:", check_same_thread=False)
+    connection.execute("CREATE TABLE metadata (artist TEXT, genre TEXT, description TEXT)")
+    connection.execute("CREATE INDEX metadata_key ON metadata (artist, description)")
+    rows = [(f"artist {i % 1000}", "['Impressionism']", f"painting-{i}") for i in range(num_rows)]
+    connection.executemany("INSERT INTO metadata VALUES (?, ?, ?)", rows)
+    return connection
+
+
+def image_id(row):
+    return f"artist-{row % 1000}_painting-{row}"
+
+
+def run(resolver, ids, batched, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        if batched:
+            resolver.resolve(ids)
+        else:
+            for i in ids:
+                resolver.resolve([i])
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=80000, help='Number of rows in the stand-in table.')
+    parser.add_argument('--round_trip_ms', type=float, default=20.0, help='Simulated latency per query.')
+    parser.add_argument('--repeats', type=int, default=5, help='Repeats per result count.')
+    args = parser.parse_args()
+
+    resolver = BatchMetadataResolver(
+        LatencyBackend(SQLiteMetadataBackend(build_database(args.rows)), args.round_trip_ms))
+
+    print(f"{'results':>8} {'per-id ms':>12} {'batched ms':>12} {'speedup':>8}")
+    for num_results in [5, 10, 20, 30, 50, 70, 100]:
+        ids = [image_id(random.randrange(args.rows)) for _ in range(num_results)]
+        per_id = run(resolver, ids, batched=False, repeats=args.repeats)
+        batched = run(resolver, ids, batched=True, repeats=args.repeats)
+        print(f"{num_results:>8} {per_id:>12.1f} {batched:>12.1f} {per_id / batched:>7.1f}x")
@@ -0,0 +1,52 @@
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tracing import Tracer, span, annotate, cache_lookup
+
+
+def fake_request(instrumented):
+    # The calls one search makes, without the work they wrap
+    if not instrumented:
+        return
+    cache_lookup("embedding", False)
+    annotate(num_results=20, filter_cardinality=3, collapse=False)
+    cache_lookup("result", False)
+    with span("encode"):
+        pass
+    with span("embed"):
+        pass
+    with span("match"):
+        pass
+    with span("metadata"):
+        pass
+    annotate(results=20)
+
+
+def run(tracer, num_requests, instrumented=True):
+    start = time.perf_counter()
+    for _ in range(num_requests):
+        if tracer is None:
+            fake_request(instrumented)
+            continue
+        with tracer.trace("text"):
+            fake_request(instrumented)
+    return (time.perf_counter() - start) / num_requests * 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_requests', type=int, default=100000, help='Requests per configuration.')
+    args = parser.parse_args()
+
+    runs = [
+        ("uninstrumented", None, False),
+        ("disabled", Tracer(enabled=False), True),
+        ("enabled", Tracer(enabled=True), True),
+    ]
+    print(f"{'tracing':>15} {'us/request':>11}")
+    for name, tracer, instrumented in runs:
+        print(f"{name:>15} {run(tracer, args.num_requests, instrumented):>11.2f}")
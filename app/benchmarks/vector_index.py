@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vector_index import DTYPES, LocalVectorIndex, Restrict, build_index, list_embedding_files, read_embedding_file
+
+
+def write_synthetic_embeddings(directory, num_embeddings, dimensions, num_categories, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((256, dimensions)).astype(np.float32)
+    path = os.path.join(directory, "synthetic.json")
+    with open(path, "w") as f:
+        for i in range(num_embeddings):
+            embedding = centers[rng.integers(len(centers))] + 1.5 * rng.standard_normal(dimensions)
+            embedding /= np.linalg.norm(embedding)
+            f.write(json.dumps({
+                "id": f"artist-{i % 1000}_painting-{i}",
+                "embedding": embedding.round(6).tolist(),
+                "restricts": [{"namespace": "category", "allow": [f"genre-{i % num_categories}"]}]
+            }) + "\n")
+    return path
+
+
+def load_embeddings(inputs):
+    ids, matrices = [], []
+    for file_name in list_embedding_files(inputs):
+        file_ids, _, matrix = read_embedding_file(file_name)
+        ids.extend(file_ids)
+        matrices.append(np.asarray(matrix, dtype=np.float32))
+    return ids, np.concatenate(matrices)
+
+
+def exact_top_k(ids, embeddings, queries, k, chunk_size=256):
+    # Brute-force ground truth on the original float32 vectors, independent of the index code
+    ground_truth = []
+    for start in range(0, len(queries), chunk_size):
+        scores = queries[start:start + chunk_size] @ embeddings.T
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        ground_truth.extend([[ids[row] for row in rows] for rows in top])
+    return ground_truth
+
+
+def evaluate(index, queries, k, mode, num_probes=None, filter=None):
+    start = time.perf_counter()
+    results = [index.search(query, k, filter, mode=mode, num_probes=num_probes) for query in queries]
+    elapsed = time.perf_counter() - start
+    return [[n.id for n in neighbors] for neighbors in results], len(queries) / elapsed
+
+
+def recall(results, ground_truth):
+    hits = sum(len(set(r) & set(g)) for r, g in zip(results, ground_truth))
+    return hits / sum(len(g) for g in ground_truth)
+
+
+def sweep(inputs, directory, queries, ground_truth, args):
+    rows = []
+    for dtype in args.dtypes:
+        for num_partitions in args.partitions:
+            index_dir = os.path.join(directory, f"index_{dtype}_{num_partitions}")
+            start = time.perf_counter()
+            count = build_index(inputs, index_dir, num_partitions=num_partitions, dtype=dtype)
+            build_seconds = time.perf_counter() - start
+            index = LocalVectorIndex(index_dir)
+            row = {
+                "dtype": dtype,
+                "partitions": num_partitions,
+                "leaf_size": count // max(num_partitions, 1),
+                "build_s": round(build_seconds, 2),
+                "mib": round(index.nbytes() / 2 ** 20, 1),
+            }
+            if num_partitions == 0:
+                results, qps = evaluate(index, queries, args.k, "exact")
+                rows.append({**row, "probe_percent": 100, "probes": None,
+                             "recall": round(recall(results, ground_truth), 4), "qps": round(qps, 1)})
+                continue
+            # Probing a percentage of partitions is what leaf_nodes_to_search_percent does
+            for probe_percent in args.probe_percents:
+                num_probes = max(1, round(num_partitions * probe_percent / 100))
+                results, qps = evaluate(index, queries, args.k, "ivf", num_probes)
+                rows.append({**row, "probe_percent": probe_percent, "probes": num_probes,
+                             "recall": round(recall(results, ground_truth), 4), "qps": round(qps, 1)})
+    return rows
+
+
+def print_table(rows, k):
+    print(f"{'dtype':>8} {'partitions':>10} {'leaf size':>9} {'probe %':>8} {'probes':>7} "
+          f"{'recall@' + str(k):>10} {'qps':>9} {'build s':>8} {'MiB':>8}")
+    for row in rows:
+        print(f"{row['dtype']:>8} {row['partitions']:>10} {row['leaf_size']:>9} {row['probe_percent']:>8} "
+              f"{row['probes'] or '-':>7} {row['recall']:>10.3f} {row['qps']:>9.1f} {row['build_s']:>8.1f} {row['mib']:>8.1f}")
+
+
+def recommend(rows, target_recall):
+    # The fastest configuration that reaches the target, in update_index's terms
+    candidates = [row for row in rows if row["recall"] >= target_recall and row["partitions"] > 0]
+    if not candidates:
+        print(f"\nNo partitioned configuration reaches recall {target_recall}")
+        return None
+    best = max(candidates, key=lambda row: row["qps"])
+    print(f"\nFastest configuration with recall >= {target_recall}: {best['dtype']}, "
+          f"leaf_node_embedding_count={best['leaf_size']}, "
+          f"leaf_nodes_to_search_percent={best['probe_percent']} "
+          f"(recall {best['recall']:.3f}, {best['qps']:.1f} qps)")
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, nargs='*', help='Exported embedding JSONL files, .npy shards or directories, synthetic data if empty.')
+    parser.add_argument('--num_embeddings', type=int, default=20000, help='Synthetic corpus size.')
+    parser.add_argument('--dimensions', type=int, default=1408, help='Synthetic embedding dimensions.')
+    parser.add_argument('--partitions', type=int, nargs='+', default=[0, 40, 80, 160], help='IVF partition counts, 0 for exact search.')
+    parser.add_argument('--probe_percents', type=int, nargs='+', default=[1, 3, 7, 15, 30], help='Percentages of partitions to probe.')
+    parser.add_argument('--dtypes', type=str, nargs='+', default=DTYPES, choices=DTYPES, help='Stored embedding types.')
+    parser.add_argument('--num_queries', type=int, default=200, help='Number of queries.')
+    parser.add_argument('--query_noise', type=float, default=0.5, help='Norm of the noise added to sampled queries.')
+    parser.add_argument('--k', type=int, default=20, help='Neighbors per query.')
+    parser.add_argument('--target_recall', type=float, default=0.95, help='Recall the recommended configuration must reach.')
+    parser.add_argument('--json', type=str, default='', help='Also write the results to this JSON file.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        inputs = args.input or [write_synthetic_embeddings(directory, args.num_embeddings, args.dimensions, 27)]
+        ids, embeddings = load_embeddings(inputs)
+
+        # Queries are corpus vectors plus noise, so they have true near neighbors without being exact copies
+        rng = np.random.default_rng(1)
+        queries = embeddings[rng.choice(len(embeddings), args.num_queries)]
+        queries = queries + args.query_noise * rng.standard_normal(queries.shape).astype(np.float32) / np.sqrt(queries.shape[1])
+        ground_truth = exact_top_k(ids, embeddings, queries, args.k)
+
+        rows = sweep(inputs, directory, queries, ground_truth, args)
+        print_table(rows, args.k)
+        best = recommend(rows, args.target_recall)
+
+        index = LocalVectorIndex(os.path.join(directory, f"index_{args.dtypes[0]}_{args.partitions[0]}"))
+        print(f"\n{'filter':>10} {'rows':>7} {'exact qps':>10}")
+        for num_categories in [1, 3, 9, len(index.category_names)]:
+            categories = index.category_names[:num_categories]
+            num_rows = sum(index.category_size(category) for category in categories)
+            _, qps = evaluate(index, queries, args.k, "exact", filter=[Restrict("category", categories, [])])
+            print(f"{num_categories:>10} {num_rows:>7} {qps:>10.1f}")
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"num_embeddings": len(ids), "k": args.k, "results": rows, "recommended": best}, f, indent=2)
@@ -0,0 +1,159 @@
+import logging
+import sqlite3
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text):
+    return " ".join(text.split()).casefold()
+
+
+class EmbeddingCache:
+    def __init__(self, max_entries=1000, disk_path=None):
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._disk = None
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB)")
+            self._disk.commit()
+
+    @staticmethod
+    def text_key(text):
+        return "text:" + hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def image_key(image_bytes):
+        return "image:" + hashlib.sha256(image_bytes).hexdigest()
+
+    def _remember(self, key, embedding):
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return embedding
+
+            if self._disk is not None:
+                row = self._disk.execute("SELECT embedding FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    embedding = array('f', row[0]).tolist()
+                    self._remember(key, embedding)
+                    self.disk_hits += 1
+                    return embedding
+
+            self.misses += 1
+            return None
+
+    def put(self, key, embedding):
+        embedding = list(embedding)
+        with self._lock:
+            self._remember(key, embedding)
+            if self._disk is not None:
+                try:
+                    self._disk.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+                                       (key, array('f', embedding).tobytes()))
+                    self._disk.commit()
+                except sqlite3.Error as ex:
+                    logger.error(f"Error writing embedding {key} to disk cache: {ex}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "memory_size": len(self._memory),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "api_calls_saved": self.hits + self.disk_hits,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+
+class ResultCache:
+    def __init__(self, max_entries=1000, precision=3):
+        self.max_entries = max_entries
+        self.precision = precision
+        self.version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hooks = []
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, embedding, filter, variant=""):
+        # variant separates result lists post-processed differently, e.g. collapsed duplicates
+        quantized = np.round(np.asarray(embedding, dtype=np.float32) * 10 ** self.precision).astype(np.int32)
+        return hashlib.sha256(quantized.tobytes()).hexdigest(), tuple(sorted(filter or [])), variant
+
+    def get(self, embedding, filter, num_results, variant=""):
+        key = self.key(embedding, filter, variant)
+        with self._lock:
+            entry = self._entries.get(key)
+            # A cached result answers any smaller k, and any k at all once the
+            # index returned fewer neighbors than were asked for.
+            if entry is not None and (entry[0] >= num_results or len(entry[1]) < entry[0]):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1][:num_results]
+            self.misses += 1
+            return None
+
+    def put(self, embedding, filter, num_results, results, variant=""):
+        key = self.key(embedding, filter, variant)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > num_results:
+                return
+            self._entries[key] = (num_results, list(results))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def add_invalidation_hook(self, hook):
+        self._hooks.append(hook)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+        for hook in self._hooks:
+            try:
+                hook()
+            except Exception as ex:
+                logger.error(f"Error running cache invalidation hook: {ex}")
+
+    def set_version(self, version):
+        if version == self.version:
+            return False
+        if self.version is not None:
+            logger.info(f"Index version changed from {self.version} to {version}, invalidating result cache")
+            self.invalidate()
+        self.version = version
+        return True
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -23,6 +23,12 @@ else
     echo "Repository $REPO_NAME already exists."
 fi
 
+# The embedding client is shared with the pipeline, refresh the app's copy in case only the pipeline's was edited
+SHARED_CLIENT=../pipeline/components/generate_embeddings/src/embedding_client.py
+if [ -f "$SHARED_CLIENT" ]; then
+    cp "$SHARED_CLIENT" .
+fi
+
 # Build Docker image
 docker build -t wikiart-app .
 
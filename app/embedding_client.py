@@ -0,0 +1,166 @@
+# Shared by the pipeline and the app. Each Docker build context needs its own copy,
+# so app/embedding_client.py is kept identical to this file, tests/test_embedding_client.py checks it.
+import time
+import random
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Quota errors and server errors both mean "back off", anything else is a bad request
+RETRYABLE_CODES = {429, 500, 502, 503, 504}
+RETRYABLE_GRPC_CODES = {"RESOURCE_EXHAUSTED", "UNAVAILABLE", "INTERNAL", "DEADLINE_EXCEEDED"}
+
+
+def is_retryable(ex):
+    # google.api_core errors carry the HTTP status in .code, raw grpc errors expose .code()
+    code = getattr(ex, "code", None)
+    if callable(code):
+        try:
+            return getattr(code(), "name", None) in RETRYABLE_GRPC_CODES
+        except Exception:
+            return False
+    return code in RETRYABLE_CODES
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self):
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    # AIMD: the limit grows by about one per window of successful requests and
+    # halves when the API pushes back
+    def __init__(self, max_limit, min_limit=1, increase=1.0, decrease=0.5, cooldown=1.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._decreased_at = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= max(self.min_limit, int(self.limit)):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                # Requests already in flight fail together, count them as one signal
+                now = time.monotonic()
+                if now - self._decreased_at >= self.cooldown:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self._decreased_at = now
+            else:
+                self.limit = min(self.max_limit, self.limit + self.increase / max(self.limit, 1.0))
+            self._condition.notify_all()
+
+
+class EmbeddingClient:
+    # Drop-in wrapper for MultiModalEmbeddingModel.get_embeddings
+    def __init__(self, model, rate=0, burst=None, max_concurrency=8, min_concurrency=1,
+                 attempts=6, base_delay=0.5, max_delay=30, rate_window=10):
+        self.model = model
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.concurrency = AdaptiveConcurrency(max_concurrency, min_concurrency)
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate_window = rate_window
+
+        self.requests = 0
+        self.throttle_events = 0
+        self.retries = 0
+        self.failures = 0
+        self._completed_at = deque()
+        self._lock = threading.Lock()
+
+    def get_embeddings(self, **kwargs):
+        for attempt in range(self.attempts):
+            if self.bucket is not None:
+                self.bucket.acquire()
+            self.concurrency.acquire()
+            try:
+                response = self.model.get_embeddings(**kwargs)
+            except Exception as ex:
+                retryable = is_retryable(ex)
+                self.concurrency.release(throttled=retryable)
+                with self._lock:
+                    self.requests += 1
+                    self.throttle_events += retryable
+                    if not retryable or attempt == self.attempts - 1:
+                        self.failures += 1
+                        raise
+                    self.retries += 1
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+                logger.warning(f"Embedding request throttled ({ex}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+
+            self.concurrency.release()
+            now = time.monotonic()
+            with self._lock:
+                self.requests += 1
+                self._completed_at.append(now)
+                self._prune(now)
+            return response
+
+    def _prune(self, now):
+        # Called with the lock held, so the deque only spans rate_window however rarely the rate is read
+        cutoff = now - self.rate_window
+        while self._completed_at and self._completed_at[0] < cutoff:
+            self._completed_at.popleft()
+
+    def current_rate(self):
+        # Successful requests per second over the last rate_window seconds
+        with self._lock:
+            self._prune(time.monotonic())
+            return len(self._completed_at) / self.rate_window
+
+    def stats(self):
+        rate = self.current_rate()
+        with self._lock:
+            return {
+                "rate": round(rate, 2),
+                "in_flight": self.concurrency.in_flight,
+                "concurrency_limit": round(self.concurrency.limit, 2),
+                "requests": self.requests,
+                "throttle_events": self.throttle_events,
+                "retries": self.retries,
+                "failures": self.failures,
+            }
+
@@ -0,0 +1,36 @@
+import io
+
+from PIL import Image as PILImage
+
+
+def encode_query_image(image_array, max_size=1024, quality=90):
+    image = PILImage.fromarray(image_array)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    # Downscale before encoding so the JPEG encoder only sees the pixels the
+    # embedding model can use; images already within limits are left as-is.
+    factor = max(image.size) // max_size
+    if factor > 1:
+        image = image.reduce(factor)
+    if max(image.size) > max_size:
+        image.thumbnail((max_size, max_size), PILImage.BILINEAR)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def encode_query_bytes(data, max_size=1024, quality=90):
+    # Uploaded files skip the array round trip: JPEGs and PNGs within limits are
+    # sent as they are, anything else is decoded at reduced size and re-encoded.
+    with PILImage.open(io.BytesIO(data)) as image:
+        if max(image.size) <= max_size and image.format in ("JPEG", "PNG"):
+            return data
+        image.draft("RGB", (max_size, max_size))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((max_size, max_size), PILImage.BILINEAR)
+
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality)
+        return buffer.getvalue()
@@ -0,0 +1,267 @@
+import time
+import logging
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+EMPTY_METADATA = ("", "", "")
+
+
+def extract_author_title(image_id):
+    parts = image_id.split('_')
+    author = parts[0].replace('-', ' ')
+    title = '_'.join(parts[1:])
+    return author, title
+
+
+def format_genre(genre):
+    cleaned_string = genre.strip("[]").replace("'", "")
+    cleaned_string = cleaned_string.split(",")[0]
+    result = cleaned_string.lower().replace(" ", "-")
+    return result
+
+
+class BigQueryMetadataBackend:
+    def __init__(self, project_id, dataset, table):
+        self.project_id = project_id
+        self.table = f"{project_id}.{dataset}.{table}"
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        with self._lock:
+            if self._client is None:
+                from google.cloud import bigquery
+                self._client = bigquery.Client(project=self.project_id)
+            return self._client
+
+    def fetch_many(self, keys):
+        from google.cloud import bigquery
+
+        if not keys:
+            return {}
+
+        query = f"""
+        SELECT t.artist, t.genre, t.description
+        FROM `{self.table}` AS t
+        JOIN UNNEST(@keys) AS k
+        ON t.artist = k.artist AND t.description = k.description
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ArrayQueryParameter("keys", "STRUCT", [
+                    bigquery.StructQueryParameter(
+                        None,
+                        bigquery.ScalarQueryParameter("artist", "STRING", artist),
+                        bigquery.ScalarQueryParameter("description", "STRING", description))
+                    for artist, description in keys])]
+        )
+
+        rows = {}
+        for row in self._get_client().query(query, job_config=job_config).result():
+            rows.setdefault((row.artist, row.description), (row.artist, row.description, row.genre))
+        return rows
+
+    def load_all(self):
+        query = f"SELECT artist, genre, description FROM `{self.table}`"
+        for row in self._get_client().query(query).result(page_size=10000):
+            yield row.artist, row.description, row.genre
+
+
+class SQLiteMetadataBackend:
+    max_keys_per_query = 400
+
+    def __init__(self, database, table="metadata"):
+        if isinstance(database, sqlite3.Connection):
+            self.connection = database
+        else:
+            self.connection = sqlite3.connect(database, check_same_thread=False)
+        self.table = table
+        self._lock = threading.Lock()
+
+    def fetch_many(self, keys):
+        rows = {}
+        for start in range(0, len(keys), self.max_keys_per_query):
+            chunk = keys[start:start + self.max_keys_per_query]
+            values = ", ".join(["(?, ?)"] * len(chunk))
+            query = f"""
+            SELECT artist, genre, description
+            FROM {self.table}
+            WHERE (artist, description) IN (VALUES {values})
+            """
+            params = [value for key in chunk for value in key]
+            with self._lock:
+                result = self.connection.execute(query, params).fetchall()
+            for artist, genre, description in result:
+                rows.setdefault((artist, description), (artist, description, genre))
+        return rows
+
+    def load_all(self):
+        with self._lock:
+            result = self.connection.execute(
+                f"SELECT artist, genre, description FROM {self.table}").fetchall()
+        for artist, genre, description in result:
+            yield artist, description, genre
+
+
+class BatchMetadataResolver:
+    def __init__(self, backend, url_fn=None):
+        self.backend = backend
+        self.url_fn = url_fn
+
+    def fetch(self, keys):
+        try:
+            rows = self.backend.fetch_many(list(dict.fromkeys(keys)))
+        except Exception as ex:
+            logger.error(f"Error querying metadata for {len(keys)} images: {ex}")
+            return None
+
+        return {key: (row[0], row[1], format_genre(row[2])) for key, row in rows.items()}
+
+    def resolve(self, image_ids):
+        keys = [extract_author_title(image_id) for image_id in image_ids]
+        rows = self.fetch(keys) or {}
+        return [rows.get(key, EMPTY_METADATA) for key in keys]
+
+    def lookup(self, image_ids):
+        # Like resolve, with the url_fn(image_id, genre) of each image appended
+        records = []
+        for image_id, (artist, description, genre) in zip(image_ids, self.resolve(image_ids)):
+            url = self.url_fn(image_id, genre) if self.url_fn else ""
+            records.append((artist, description, genre, url))
+        return records
+
+
+class MetadataStore(BatchMetadataResolver):
+    def __init__(self, backend, max_cache_entries=10000, ttl_seconds=3600, url_fn=None):
+        super().__init__(backend, url_fn)
+        self.max_cache_entries = max_cache_entries
+        self.ttl_seconds = ttl_seconds
+
+        # Column-oriented index: artists and genres are interned into small
+        # tables and referenced by code, descriptions are kept as-is.
+        self._positions = {}
+        self._artist_codes = array('I')
+        self._genre_codes = array('H')
+        self._descriptions = []
+        self._artists = []
+        self._genres = []
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.index_hits = 0
+        self.cache_hits = 0
+        self.misses = 0
+
+    def load(self):
+        start = time.perf_counter()
+        positions = {}
+        artist_codes, genre_codes = array('I'), array('H')
+        descriptions, artists, genres = [], [], []
+        artist_lookup, genre_lookup = {}, {}
+
+        for artist, description, genre in self.backend.load_all():
+            key = (artist, description)
+            if key in positions:
+                continue
+            genre = format_genre(genre)
+            if artist not in artist_lookup:
+                artist_lookup[artist] = len(artists)
+                artists.append(artist)
+            if genre not in genre_lookup:
+                genre_lookup[genre] = len(genres)
+                genres.append(genre)
+            positions[key] = len(descriptions)
+            artist_codes.append(artist_lookup[artist])
+            genre_codes.append(genre_lookup[genre])
+            descriptions.append(description)
+
+        with self._lock:
+            self._positions = positions
+            self._artist_codes, self._genre_codes = artist_codes, genre_codes
+            self._descriptions, self._artists, self._genres = descriptions, artists, genres
+            self._cache.clear()
+
+        logger.info(f"Loaded metadata for {len(descriptions)} images "
+                    f"in {time.perf_counter() - start:.1f}s")
+
+    def __len__(self):
+        return len(self._descriptions)
+
+    def _from_index(self, key):
+        position = self._positions.get(key)
+        if position is None:
+            return None
+        return (self._artists[self._artist_codes[position]],
+                self._descriptions[position],
+                self._genres[self._genre_codes[position]])
+
+    def _from_cache(self, key, now):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < now:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return value
+
+    def _store(self, key, value, now):
+        self._cache[key] = (now + self.ttl_seconds, value)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_cache_entries:
+            self._cache.popitem(last=False)
+
+    def resolve(self, image_ids):
+        keys = [extract_author_title(image_id) for image_id in image_ids]
+        found = {}
+        missing = {}
+        now = time.monotonic()
+
+        with self._lock:
+            for key in keys:
+                if key in found:
+                    continue
+                value = self._from_index(key)
+                if value is not None:
+                    self.index_hits += 1
+                else:
+                    value = self._from_cache(key, now)
+                    if value is not None:
+                        self.cache_hits += 1
+                if value is not None:
+                    found[key] = value
+                else:
+                    missing[key] = None
+            self.misses += len(missing)
+
+        if missing:
+            rows = self.fetch(list(missing))
+            if rows is not None:
+                with self._lock:
+                    for key in missing:
+                        # Blank results are cached too, so unknown ids don't hit BigQuery on every search.
+                        self._store(key, rows.get(key, EMPTY_METADATA), now)
+                found.update(rows)
+
+        return [found.get(key, EMPTY_METADATA) for key in keys]
+
+    def invalidate(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.index_hits + self.cache_hits + self.misses
+            return {
+                "index_size": len(self._descriptions),
+                "cache_size": len(self._cache),
+                "index_hits": self.index_hits,
+                "cache_hits": self.cache_hits,
+                "misses": self.misses,
+                "hit_rate": (self.index_hits + self.cache_hits) / lookups if lookups else 0.0,
+            }
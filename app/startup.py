@@ -0,0 +1,84 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTask:
+    def __init__(self, name, fn, requires=(), critical=True):
+        self.name = name
+        self.fn = fn
+        self.requires = tuple(requires)
+        self.critical = critical
+        self.state = "pending"
+        self.seconds = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Startup:
+    # Runs named initialization tasks on their own threads as soon as the tasks
+    # they require have finished, and tracks whether the app can take traffic.
+    def __init__(self):
+        self.tasks = {}
+        self.started_at = None
+        self.startup_seconds = None
+        self._ready = threading.Event()
+
+    def add(self, name, fn, requires=(), critical=True):
+        # A failed critical task keeps the app unready, a failed optional task is only logged
+        self.tasks[name] = StartupTask(name, fn, requires, critical)
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        for task in self.tasks.values():
+            threading.Thread(target=self._run, args=(task,), name=f"startup-{task.name}", daemon=True).start()
+        threading.Thread(target=self._finish, name="startup", daemon=True).start()
+
+    def _run(self, task):
+        for name in task.requires:
+            self.tasks[name].done.wait()
+        failed = [name for name in task.requires if self.tasks[name].state != "done"]
+        if failed:
+            task.state, task.error = "failed", f"requires {', '.join(failed)}"
+            task.done.set()
+            return
+
+        task.state = "running"
+        start = time.perf_counter()
+        try:
+            task.fn()
+            task.state = "done"
+        except Exception as ex:
+            logger.error(f"Startup task {task.name} failed: {ex}")
+            task.state, task.error = "failed", str(ex)
+        task.seconds = time.perf_counter() - start
+        task.done.set()
+
+    def _finish(self):
+        for task in self.tasks.values():
+            task.done.wait()
+        self.startup_seconds = time.perf_counter() - self.started_at
+        breakdown = ", ".join(f"{task.name} {task.seconds:.2f}s" if task.seconds is not None
+                              else f"{task.name} skipped" for task in self.tasks.values())
+        if self.failed():
+            logger.error(f"Startup failed after {self.startup_seconds:.2f}s: {breakdown}")
+            return
+        logger.info(f"Ready in {self.startup_seconds:.2f}s: {breakdown}")
+        self._ready.set()
+
+    def ready(self):
+        return self._ready.is_set()
+
+    def failed(self):
+        return [task.name for task in self.tasks.values() if task.critical and task.state == "failed"]
+
+    def status(self):
+        return {
+            "ready": self.ready(),
+            "failed": self.failed(),
+            "startup_seconds": self.startup_seconds,
+            "tasks": {task.name: {"state": task.state, "seconds": task.seconds, "error": task.error}
+                      for task in self.tasks.values()},
+        }
@@ -0,0 +1,208 @@
+import json
+import time
+import logging
+import threading
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+
+logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger("trace")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+_current = contextvars.ContextVar("trace", default=None)
+_disabled = nullcontext()
+
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{format_labels(labels, le=le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.series = {}
+
+    def inc(self, labels, value=1):
+        self.series[labels] = self.series.get(labels, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.series.items()):
+            lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+
+def format_labels(labels, **extra):
+    # labels are tuples of (name, value) pairs so they can key a dict
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter("search_requests_total", "Search requests by kind and outcome.")
+        self.request_seconds = Histogram("search_request_seconds", "End-to-end search latency.", LATENCY_BUCKETS)
+        self.stage_seconds = Histogram("search_stage_seconds", "Time spent per search stage.", LATENCY_BUCKETS)
+        self.cache = Counter("search_cache_lookups_total", "Cache lookups by cache and result.")
+        self.results = Histogram("search_results", "Results returned per search.", COUNT_BUCKETS)
+        self.filter_cardinality = Histogram("search_filter_cardinality", "Genres in the search filter.", COUNT_BUCKETS)
+        self._gauges = []
+
+    def add_gauges(self, prefix, fn):
+        # fn() returns a dict of numbers, exported as gauges when the endpoint is scraped
+        self._gauges.append((prefix, fn))
+
+    def record(self, trace, total):
+        kind = (("kind", trace.kind),)
+        with self._lock:
+            self.requests.inc(kind + (("outcome", "error" if trace.error else "ok"),))
+            self.request_seconds.observe(kind, total)
+            for stage, seconds in trace.spans:
+                self.stage_seconds.observe((("stage", stage),), seconds)
+            for cache, hit in trace.cache_hits:
+                self.cache.inc((("cache", cache), ("result", "hit" if hit else "miss")))
+            if "results" in trace.attributes:
+                self.results.observe(kind, trace.attributes["results"])
+            if "filter_cardinality" in trace.attributes:
+                self.filter_cardinality.observe(kind, trace.attributes["filter_cardinality"])
+
+    def render(self):
+        with self._lock:
+            lines = []
+            for metric in (self.requests, self.request_seconds, self.stage_seconds,
+                           self.cache, self.results, self.filter_cardinality):
+                lines.extend(metric.render())
+        for prefix, fn in self._gauges:
+            try:
+                values = fn()
+            except Exception as ex:
+                logger.error(f"Error collecting {prefix} metrics: {ex}")
+                continue
+            for name, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"# TYPE {prefix}_{name} gauge")
+                    lines.append(f"{prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class Trace:
+    def __init__(self, kind):
+        self.kind = kind
+        self.started_at = time.perf_counter()
+        self.spans = []
+        self.cache_hits = []
+        self.attributes = {}
+        self.error = None
+
+
+class Tracer:
+    def __init__(self, enabled=False, json_logs=False):
+        self.enabled = enabled
+        self.json_logs = json_logs
+        self.metrics = Metrics()
+        if json_logs and not trace_logger.handlers:
+            # One JSON object per line, without the text prefix of the app log format
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            trace_logger.addHandler(handler)
+            trace_logger.setLevel(logging.INFO)
+            trace_logger.propagate = False
+
+    @contextmanager
+    def _trace(self, kind):
+        trace = Trace(kind)
+        token = _current.set(trace)
+        try:
+            yield trace
+        except Exception as ex:
+            trace.error = str(ex)
+            raise
+        finally:
+            _current.reset(token)
+            self.finish(trace)
+
+    def trace(self, kind):
+        # One trace per request, the spans of the request attach to it through a context variable
+        if not self.enabled:
+            return _disabled
+        return self._trace(kind)
+
+    def finish(self, trace):
+        total = time.perf_counter() - trace.started_at
+        self.metrics.record(trace, total)
+        if self.json_logs:
+            trace_logger.info(json.dumps({
+                "timestamp": time.time(),
+                "trace": trace.kind,
+                "duration_ms": round(total * 1000, 2),
+                "spans": [{"stage": stage, "duration_ms": round(seconds * 1000, 2)} for stage, seconds in trace.spans],
+                "cache_hits": dict(trace.cache_hits),
+                **trace.attributes,
+                **({"error": trace.error} if trace.error else {}),
+            }))
+
+
+@contextmanager
+def _span(trace, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.spans.append((stage, time.perf_counter() - start))
+
+
+def span(stage):
+    trace = _current.get()
+    if trace is None:
+        return _disabled
+    return _span(trace, stage)
+
+
+def cache_lookup(cache, hit):
+    trace = _current.get()
+    if trace is not None:
+        trace.cache_hits.append((cache, hit))
+
+
+def record_error(ex):
+    # For handlers that catch their own exceptions
+    trace = _current.get()
+    if trace is not None:
+        trace.error = str(ex)
+
+
+def annotate(**attributes):
+    trace = _current.get()
+    if trace is not None:
+        trace.attributes.update(attributes)
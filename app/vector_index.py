@@ -0,0 +1,385 @@
+import os
+import glob
+import json
+import heapq
+import logging
+import argparse
+from abc import ABC, abstractmethod
+from itertools import islice
+from collections import namedtuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+Neighbor = namedtuple("Neighbor", ["id", "distance"])
+# Same fields as the Vertex AI SDK's Namespace, so the local index needs no SDK to filter
+Restrict = namedtuple("Restrict", ["name", "allow_tokens", "deny_tokens"])
+
+EMBEDDINGS_FILE = "embeddings.npy"
+UNSORTED_EMBEDDINGS_FILE = "embeddings.unsorted.npy"
+IDS_FILE = "ids.json"
+CATEGORY_NAMES_FILE = "category_names.json"
+CENTROIDS_FILE = "centroids.npy"
+BLOCK_OFFSETS_FILE = "block_offsets.npy"
+SCALES_FILE = "scales.npy"
+DTYPES = ["float32", "float16", "int8"]
+
+
+class VectorIndex(ABC):
+    @abstractmethod
+    def match(self, deployed_index_id, queries, num_neighbors=1, filter=None, **kwargs):
+        pass
+
+
+class RemoteVectorIndex(VectorIndex):
+    def __init__(self, index_endpoint):
+        self.index_endpoint = index_endpoint
+
+    def match(self, deployed_index_id, queries, num_neighbors=1, filter=None, **kwargs):
+        from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import Namespace
+
+        return self.index_endpoint.match(deployed_index_id,
+                                         queries=queries,
+                                         num_neighbors=num_neighbors,
+                                         filter=[Namespace(restrict.name, restrict.allow_tokens, restrict.deny_tokens)
+                                                 for restrict in filter or []],
+                                         **kwargs)
+
+
+def list_embedding_files(paths):
+    # Vertex AI JSONL files, or .npy shards with a .meta.json sidecar
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(name for name in glob.glob(os.path.join(path, "*.json"))
+                                if not name.endswith(".meta.json")))
+            files.extend(sorted(glob.glob(os.path.join(path, "*.npy"))))
+        else:
+            files.append(path)
+    return files
+
+
+def read_datapoints(files):
+    for file_name in files:
+        with open(file_name) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def get_categories(restricts):
+    # A painting whose copies are filed under other genres is allowed in all of them
+    for restrict in restricts:
+        if restrict["namespace"] == "category" and restrict.get("allow"):
+            return restrict["allow"]
+    return [""]
+
+
+def read_shard(file_name):
+    with open(file_name[:-4] + ".meta.json") as f:
+        sidecar = json.load(f)
+    matrix = np.load(file_name, mmap_mode="r")
+    if sidecar["dtype"] == "int8":
+        matrix = matrix.astype(np.float32) * np.asarray(sidecar["scales"], dtype=np.float32)[:, None]
+    return sidecar["ids"], [get_categories(restricts) for restricts in sidecar["restricts"]], matrix
+
+
+def read_embedding_file(file_name):
+    if file_name.endswith(".npy"):
+        return read_shard(file_name)
+
+    ids, categories, embeddings = [], [], []
+    for datapoint in read_datapoints([file_name]):
+        ids.append(datapoint["id"])
+        categories.append(get_categories(datapoint.get("restricts", [])))
+        embeddings.append(datapoint["embedding"])
+    return ids, categories, np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)
+
+
+def count_embeddings(file_name):
+    if file_name.endswith(".npy"):
+        return np.load(file_name, mmap_mode="r").shape
+
+    count, dimensions = 0, None
+    with open(file_name) as f:
+        for line in f:
+            if line.strip():
+                dimensions = dimensions or len(json.loads(line)["embedding"])
+                count += 1
+    return count, dimensions
+
+
+def train_centroids(embeddings, num_partitions, iterations=10, sample_size=50000, seed=0):
+    rng = np.random.default_rng(seed)
+    sample_rows = np.sort(rng.choice(len(embeddings), min(len(embeddings), sample_size), replace=False))
+    sample = np.asarray(embeddings[sample_rows], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), num_partitions, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        nonempty = norms[:, 0] > 0
+        centroids[nonempty] = sums[nonempty] / norms[nonempty]
+
+    return centroids
+
+
+def assign_partitions(embeddings, centroids, chunk_size=8192):
+    assignments = np.empty(len(embeddings), dtype=np.int32)
+    for start in range(0, len(embeddings), chunk_size):
+        chunk = np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)
+        assignments[start:start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def quantize(embeddings, dtype):
+    # Same scheme as the pipeline's .npy shards: float16, or int8 with one scale per row
+    if dtype == "float16":
+        return embeddings.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.abs(embeddings).max(axis=1) / 127
+        scales[scales == 0] = 1
+        return np.round(embeddings / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    return embeddings, None
+
+
+def build_index(input_paths, directory, num_partitions=0, seed=0, chunk_size=8192, dtype="float32"):
+    if dtype not in DTYPES:
+        raise ValueError(f"Unsupported dtype {dtype}, expected one of {DTYPES}")
+    files = list_embedding_files(input_paths)
+    os.makedirs(directory, exist_ok=True)
+
+    count, dimensions = 0, None
+    for file_name in files:
+        file_count, file_dimensions = count_embeddings(file_name)
+        dimensions = dimensions or file_dimensions
+        count += file_count
+    if count == 0:
+        raise ValueError(f"No embeddings found in {input_paths}")
+
+    unsorted_path = os.path.join(directory, UNSORTED_EMBEDDINGS_FILE)
+    unsorted = np.lib.format.open_memmap(unsorted_path, mode="w+", dtype=np.float32, shape=(count, dimensions))
+    ids = []
+    # One (datapoint, category) pair per allowed category, so a datapoint in
+    # several genres is stored once in the block of each of them
+    sources, categories = [], []
+    category_names = {}
+    for file_name in files:
+        file_ids, file_categories, matrix = read_embedding_file(file_name)
+        row = len(ids)
+        unsorted[row:row + len(file_ids)] = matrix
+        for offset, datapoint_categories in enumerate(file_categories):
+            for category in datapoint_categories:
+                sources.append(row + offset)
+                categories.append(category_names.setdefault(category, len(category_names)))
+        ids.extend(file_ids)
+    unsorted.flush()
+    sources = np.asarray(sources, dtype=np.int64)
+    categories = np.asarray(categories, dtype=np.int32)
+
+    if num_partitions > 0:
+        centroids = train_centroids(unsorted, num_partitions, seed=seed)
+        partitions = assign_partitions(unsorted, centroids)
+        np.save(os.path.join(directory, CENTROIDS_FILE), centroids)
+    else:
+        partitions = np.zeros(count, dtype=np.int32)
+        num_partitions = 1
+
+    # Rows are laid out category-major so that every genre is one contiguous
+    # block, and every IVF partition is a contiguous run inside its block.
+    order = np.lexsort((partitions[sources], categories))
+    rows = sources[order]
+    embeddings = np.lib.format.open_memmap(os.path.join(directory, EMBEDDINGS_FILE),
+                                           mode="w+", dtype=np.dtype(dtype), shape=(len(rows), dimensions))
+    scales = np.empty(len(rows), dtype=np.float32) if dtype == "int8" else None
+    for start in range(0, len(rows), chunk_size):
+        chunk, chunk_scales = quantize(unsorted[rows[start:start + chunk_size]], dtype)
+        embeddings[start:start + chunk_size] = chunk
+        if scales is not None:
+            scales[start:start + chunk_size] = chunk_scales
+    embeddings.flush()
+    del unsorted
+    os.remove(unsorted_path)
+    if scales is not None:
+        np.save(os.path.join(directory, SCALES_FILE), scales)
+    elif os.path.exists(os.path.join(directory, SCALES_FILE)):
+        os.remove(os.path.join(directory, SCALES_FILE))
+
+    block_keys = categories[order].astype(np.int64) * num_partitions + partitions[rows]
+    starts = np.searchsorted(block_keys, np.arange(len(category_names) * num_partitions + 1))
+    block_offsets = np.empty((len(category_names), num_partitions + 1), dtype=np.int64)
+    block_offsets[:, :num_partitions] = starts[:-1].reshape(len(category_names), num_partitions)
+    block_offsets[:, num_partitions] = starts[num_partitions::num_partitions]
+
+    with open(os.path.join(directory, IDS_FILE), "w") as f:
+        json.dump([ids[row] for row in rows], f)
+    with open(os.path.join(directory, CATEGORY_NAMES_FILE), "w") as f:
+        json.dump(list(category_names), f)
+    np.save(os.path.join(directory, BLOCK_OFFSETS_FILE), block_offsets)
+
+    logger.info(f"Built local {dtype} index with {count} embeddings of dimension {dimensions} "
+                f"in {len(category_names)} category blocks ({len(rows)} rows) in {directory}")
+    return count
+
+
+def unique_rows(ranked, ids):
+    # Each painting once, at its best score
+    seen = set()
+    for score, row in ranked:
+        if ids[row] not in seen:
+            seen.add(ids[row])
+            yield score, row
+
+
+class LocalVectorIndex(VectorIndex):
+    def __init__(self, directory, mode="exact", num_probes=8):
+        self.directory = directory
+        self.mode = mode
+        self.num_probes = num_probes
+
+        self.embeddings = np.load(os.path.join(directory, EMBEDDINGS_FILE), mmap_mode="r")
+        self.dimensions = self.embeddings.shape[1]
+        with open(os.path.join(directory, IDS_FILE)) as f:
+            self.ids = json.load(f)
+        with open(os.path.join(directory, CATEGORY_NAMES_FILE)) as f:
+            self.category_names = json.load(f)
+        self.category_codes = {name: code for code, name in enumerate(self.category_names)}
+        # Paintings allowed in several genres have a row in each of their blocks
+        self.has_copies = len(set(self.ids)) < len(self.ids)
+        # block_offsets[c, p]:block_offsets[c, p + 1] are the rows of category c in partition p.
+        self.block_offsets = np.load(os.path.join(directory, BLOCK_OFFSETS_FILE))
+        self.scales = None
+        if os.path.exists(os.path.join(directory, SCALES_FILE)):
+            self.scales = np.load(os.path.join(directory, SCALES_FILE))
+
+        self.centroids = None
+        if os.path.exists(os.path.join(directory, CENTROIDS_FILE)):
+            self.centroids = np.load(os.path.join(directory, CENTROIDS_FILE))
+        elif mode == "ivf":
+            raise ValueError(f"Index in {directory} was built without partitions")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def category_size(self, category):
+        code = self.category_codes[category]
+        return int(self.block_offsets[code, -1] - self.block_offsets[code, 0])
+
+    def allowed_categories(self, filter):
+        # Mirrors Vertex AI namespace restricts on the "category" namespace:
+        # an empty allow list means no restriction, deny tokens always apply.
+        allowed = set(range(len(self.category_names)))
+        for namespace in filter or []:
+            if namespace.name != "category":
+                continue
+            if namespace.allow_tokens:
+                allowed &= {self.category_codes[token] for token in namespace.allow_tokens
+                            if token in self.category_codes}
+            if namespace.deny_tokens:
+                allowed -= {self.category_codes[token] for token in namespace.deny_tokens
+                            if token in self.category_codes}
+        return sorted(allowed)
+
+    def category_runs(self, categories):
+        # Adjacent categories are adjacent on disk, so they are scanned as one run.
+        runs = []
+        for category in categories:
+            start, end = self.block_offsets[category, 0], self.block_offsets[category, -1]
+            if start == end:
+                continue
+            # A run over two blocks could rank both rows of one painting, they are kept apart
+            if runs and runs[-1][1] == start and not self.has_copies:
+                runs[-1] = (runs[-1][0], end)
+            else:
+                runs.append((start, end))
+        return runs
+
+    def probes(self, query, categories, num_neighbors, num_probes=None):
+        # Only partitions holding rows of the selected categories are probed, nearest
+        # first, and past num_probes until they hold num_neighbors rows. A rare
+        # genre is then scanned whole instead of losing the rows of unprobed partitions.
+        counts = (self.block_offsets[categories, 1:] - self.block_offsets[categories, :-1]).sum(axis=0)
+        order = np.argsort(-(self.centroids @ query))
+        order = order[counts[order] > 0]
+        covered = np.cumsum(counts[order])
+        num_probes = max(num_probes or self.num_probes, int(np.searchsorted(covered, num_neighbors)) + 1)
+        return np.sort(order[:num_probes])
+
+    def probed_rows(self, categories, probes):
+        starts = self.block_offsets[np.ix_(categories, probes)].ravel()
+        lengths = self.block_offsets[np.ix_(categories, probes + 1)].ravel() - starts
+        skipped = np.cumsum(lengths) - lengths
+        return np.arange(lengths.sum()) + np.repeat(starts - skipped, lengths)
+
+    def nbytes(self):
+        # Bytes that have to be resident to serve queries without touching disk
+        total = self.embeddings.nbytes + self.block_offsets.nbytes
+        for array in (self.centroids, self.scales):
+            if array is not None:
+                total += array.nbytes
+        return total
+
+    def score(self, query, block):
+        rows = slice(*block) if isinstance(block, tuple) else block
+        embeddings = self.embeddings[rows]
+        if embeddings.dtype != np.float32:
+            # Quantized rows are widened a block at a time, never the whole index
+            embeddings = embeddings.astype(np.float32)
+        scores = embeddings @ query
+        if self.scales is not None:
+            scores *= self.scales[rows]
+        return scores
+
+    def top_k(self, query, block, num_neighbors):
+        scores = self.score(query, block)
+        num_neighbors = min(num_neighbors, len(scores))
+        if num_neighbors <= 0:
+            return []
+
+        top = np.argpartition(-scores, num_neighbors - 1)[:num_neighbors]
+        top = top[np.argsort(-scores[top])]
+        rows = block[0] + top if isinstance(block, tuple) else block[top]
+        return list(zip(scores[top].tolist(), rows.tolist()))
+
+    def search(self, query, num_neighbors, filter=None, mode=None, num_probes=None):
+        query = np.asarray(query, dtype=np.float32)
+        mode = mode or self.mode
+        categories = self.allowed_categories(filter)
+        if not categories:
+            return []
+
+        # Only the blocks of the selected categories are scanned. Each run
+        # yields its own sorted top-k and the runs are merged with a heap.
+        if mode == "ivf":
+            probes = self.probes(query, categories, num_neighbors, num_probes)
+            if self.has_copies:
+                blocks = [self.probed_rows([category], probes) for category in categories]
+            else:
+                blocks = [self.probed_rows(categories, probes)]
+        else:
+            blocks = self.category_runs(categories)
+
+        ranked = [self.top_k(query, block, num_neighbors) for block in blocks]
+        merged = heapq.merge(*ranked, reverse=True)
+        if self.has_copies:
+            merged = unique_rows(merged, self.ids)
+        return [Neighbor(self.ids[row], score) for score, row in islice(merged, num_neighbors)]
+
+    def match(self, deployed_index_id, queries, num_neighbors=1, filter=None, **kwargs):
+        return [self.search(query, num_neighbors, filter) for query in queries]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, nargs='+', required=True, help='Embedding JSONL files, .npy shards or directories.')
+    parser.add_argument('--output', type=str, required=True, help='Directory for the local index.')
+    parser.add_argument('--num_partitions', type=int, default=0, help='IVF partitions, 0 for exact search only.')
+    parser.add_argument('--dtype', type=str, default='float32', choices=DTYPES, help='Element type of the stored embeddings.')
+    args = parser.parse_args()
+
+    build_index(args.input, args.output, num_partitions=args.num_partitions, dtype=args.dtype)
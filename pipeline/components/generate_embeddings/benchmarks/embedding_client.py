@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from embedding_client import EmbeddingClient
+from fake_embedding_model import FakeEmbeddingModel
+
+
+def run(client, num_images, threads):
+    lost = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(client.get_embeddings, image=i) for i in range(num_images)]
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                lost += 1
+    return (num_images - lost) / (time.perf_counter() - start), lost
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_images', type=int, default=300, help='Embedding requests per run.')
+    parser.add_argument('--threads', type=int, default=32, help='Threads calling the model, as the embed stage does.')
+    parser.add_argument('--quota', type=float, default=40.0, help='Fake model quota in requests/sec.')
+    parser.add_argument('--latency_ms', type=float, default=100.0, help='Fake model latency.')
+    parser.add_argument('--error_rate', type=float, default=0.02, help='Fake model 503 rate.')
+    args = parser.parse_args()
+
+    runs = [
+        ("unthrottled", lambda model: model),
+        ("aimd", lambda model: EmbeddingClient(model, max_concurrency=args.threads)),
+        ("aimd+bucket", lambda model: EmbeddingClient(model, rate=args.quota, max_concurrency=args.threads)),
+    ]
+    print(f"{'client':>12} {'images/sec':>11} {'lost':>6} {'model calls':>12} {'throttled':>10} {'final limit':>12}")
+    for name, make_client in runs:
+        model = FakeEmbeddingModel(latency_ms=args.latency_ms, quota_per_sec=args.quota, error_rate=args.error_rate)
+        client = make_client(model)
+        rate, lost = run(client, args.num_images, args.threads)
+        stats = client.stats() if isinstance(client, EmbeddingClient) else {}
+        print(f"{name:>12} {rate:>11.1f} {lost:>6} {model.calls:>12} "
+              f"{stats.get('throttle_events', '-'):>10} {stats.get('concurrency_limit', '-'):>12}")
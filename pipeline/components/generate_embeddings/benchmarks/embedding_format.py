@@ -0,0 +1,63 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from embedding_format import DTYPES, jsonl_to_shard, read_shard, shard_paths
+
+
+def write_jsonl(path, num_embeddings, dimensions):
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((num_embeddings, dimensions)).astype(np.float32) / np.sqrt(dimensions)
+    with open(path, "w") as f:
+        for i, embedding in enumerate(embeddings):
+            f.write(json.dumps({
+                "id": f"artist-{i}_painting-{i}",
+                "embedding": embedding.tolist(),
+                "restricts": [{"namespace": "category", "allow": ["impressionism"]}]
+            }) + "\n")
+    return embeddings
+
+
+def load_jsonl(path):
+    with open(path) as f:
+        return np.asarray([json.loads(line)["embedding"] for line in f], dtype=np.float32)
+
+
+def timed(fn, repeats=3):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_embeddings', type=int, default=10000, help='Embeddings per file.')
+    parser.add_argument('--dimensions', type=int, default=1408, help='Embedding dimensions.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        jsonl_path = os.path.join(directory, "embeddings.json")
+        original = write_jsonl(jsonl_path, args.num_embeddings, args.dimensions)
+
+        print(f"{'format':>10} {'MiB':>8} {'load ms':>9} {'max abs err':>12}")
+        elapsed, loaded = timed(lambda: load_jsonl(jsonl_path))
+        size = os.path.getsize(jsonl_path) / 2 ** 20
+        print(f"{'jsonl':>10} {size:>8.1f} {elapsed:>9.1f} {np.abs(loaded - original).max():>12.2e}")
+
+        for dtype in DTYPES:
+            base = os.path.join(directory, f"embeddings_{dtype}")
+            jsonl_to_shard(jsonl_path, base, dtype)
+            size = sum(os.path.getsize(path) for path in shard_paths(base)) / 2 ** 20
+            # Dequantizing reads every value, so it is timed as a full load
+            elapsed, (_, _, loaded) = timed(lambda: read_shard(base, mmap=False))
+            print(f"{dtype:>10} {size:>8.1f} {elapsed:>9.1f} {np.abs(np.asarray(loaded) - original).max():>12.2e}")
@@ -0,0 +1,37 @@
+import time
+import random
+import threading
+from types import SimpleNamespace
+
+from embedding_client import TokenBucket
+
+
+class FakeQuotaError(Exception):
+    code = 429
+
+
+class FakeServerError(Exception):
+    code = 503
+
+
+class FakeEmbeddingModel:
+    # Stands in for MultiModalEmbeddingModel in local runs: it adds latency,
+    # enforces a request quota and injects server errors
+    def __init__(self, latency_ms=100, quota_per_sec=0, error_rate=0.0, dimensions=1408):
+        self.latency = latency_ms / 1000
+        self.quota = TokenBucket(quota_per_sec) if quota_per_sec > 0 else None
+        self.error_rate = error_rate
+        self.embedding = [1.0 / dimensions ** 0.5] * dimensions
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def get_embeddings(self, image=None, contextual_text=None, **kwargs):
+        with self._lock:
+            self.calls += 1
+        if self.quota is not None and not self.quota.try_acquire():
+            raise FakeQuotaError("Quota exceeded for online prediction requests per minute")
+        time.sleep(self.latency * random.uniform(0.8, 1.2))
+        if random.random() < self.error_rate:
+            raise FakeServerError("The service is currently unavailable")
+        return SimpleNamespace(image_embedding=self.embedding if image is not None else None,
+                               text_embedding=self.embedding if contextual_text is not None else None)
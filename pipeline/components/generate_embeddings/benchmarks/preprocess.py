@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from collections import deque
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image as PILImage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from preprocess import preprocess_image, MAX_SIZE
+
+
+def resize_full_decode(data):
+    # The previous resize: decode at full resolution, LANCZOS thumbnail, re-encode
+    with PILImage.open(BytesIO(data)) as im:
+        im.thumbnail((MAX_SIZE, MAX_SIZE), PILImage.LANCZOS)
+        buffer = BytesIO()
+        im.save(buffer, format=im.format or "JPEG")
+        return buffer.getvalue()
+
+
+def write_sample_images(directory, count, size):
+    # Smooth gradients plus noise compress like scans of paintings, unlike pure noise
+    for i in range(count):
+        width, height = size, int(size * (0.6 + 0.1 * (i % 5)))
+        gradient = PILImage.linear_gradient("L").resize((width, height))
+        noise = PILImage.effect_noise((width, height), 40)
+        im = PILImage.merge("RGB", (gradient, noise, gradient.rotate(90).resize((width, height))))
+        im.save(os.path.join(directory, f"sample_{i}.jpg"), quality=92)
+    # A few images already within limits, which preprocessing passes through untouched
+    for i in range(max(1, count // 10)):
+        PILImage.effect_noise((800, 600), 60).convert("RGB").save(os.path.join(directory, f"small_{i}.jpg"))
+
+
+def read_images(directory):
+    # Read lazily so peak RSS reflects decoding rather than the whole sample held in memory
+    for file_name in sorted(os.listdir(directory)):
+        if file_name.lower().endswith((".jpg", ".jpeg", ".png")):
+            with open(os.path.join(directory, file_name), "rb") as f:
+                yield f.read()
+
+
+def peak_rss_mib(who):
+    # ru_maxrss is in KiB on Linux; for children it is the largest single child
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def run_mode(mode, directory, workers, results):
+    fn = resize_full_decode if mode == "full-decode" else preprocess_image
+    count, bytes_in, bytes_out = 0, 0, 0
+    start = time.perf_counter()
+    if mode == "draft-pool":
+        # Keep a bounded number of images in flight, as the pipeline's queues do
+        pool = ProcessPoolExecutor(max_workers=workers)
+        pending = deque()
+        for data in read_images(directory):
+            if len(pending) >= 2 * workers:
+                bytes_out += len(pending.popleft().result())
+            pending.append(pool.submit(fn, data))
+            count, bytes_in = count + 1, bytes_in + len(data)
+        bytes_out += sum(len(future.result()) for future in pending)
+        pool.shutdown()
+    else:
+        for data in read_images(directory):
+            count, bytes_in, bytes_out = count + 1, bytes_in + len(data), bytes_out + len(fn(data))
+    elapsed = time.perf_counter() - start
+    results.put((mode, count / elapsed, peak_rss_mib(resource.RUSAGE_SELF),
+                 peak_rss_mib(resource.RUSAGE_CHILDREN), bytes_out / bytes_in))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_dir', type=str, default='', help='Folder of sample images, generated if empty.')
+    parser.add_argument('--num_images', type=int, default=40, help='Images to generate without --input_dir.')
+    parser.add_argument('--image_size', type=int, default=4000, help='Longest side of generated images.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes for the pooled run.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as generated:
+        directory = args.input_dir
+        if not directory:
+            directory = generated
+            write_sample_images(directory, args.num_images, args.image_size)
+
+        print(f"{'mode':>12} {'images/sec':>11} {'peak RSS MiB':>13} {'worker RSS MiB':>15} {'out/in bytes':>13}")
+        # Each mode runs in a fresh process so peak RSS is not carried over between modes
+        results = multiprocessing.Queue()
+        for mode in ["full-decode", "draft", "draft-pool"]:
+            process = multiprocessing.Process(target=run_mode, args=(mode, directory, args.workers, results))
+            process.start()
+            mode, rate, rss, worker_rss, ratio = results.get()
+            process.join()
+            worker = f"{worker_rss:.1f}" if mode == "draft-pool" else "-"
+            print(f"{mode:>12} {rate:>11.1f} {rss:>13.1f} {worker:>15} {ratio:>13.2f}")
@@ -0,0 +1,196 @@
+import os
+import time
+import base64
+import random
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+BlobInfo = namedtuple("BlobInfo", ["name", "generation", "md5"])
+
+
+TRANSIENT_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def is_transient(ex):
+    # google.api_core errors carry the HTTP status in .code, dropped connections and timeouts don't
+    code = getattr(ex, "code", None)
+    if isinstance(code, int):
+        return code in TRANSIENT_CODES
+    if isinstance(ex, (ConnectionError, TimeoutError)):
+        return True
+    try:
+        import requests
+    except ImportError:
+        return False
+    return isinstance(ex, (requests.ConnectionError, requests.Timeout))
+
+
+def with_retries(fn, attempts=5, base_delay=0.5, max_delay=16):
+    # Retries transient errors with jittered exponential backoff, anything else fails fast
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except Exception as ex:
+            if not is_transient(ex) or attempt == attempts - 1:
+                raise
+            delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+            logging.warning(f"Storage call failed ({ex}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+class GcsBackend:
+    def __init__(self, pool_size=32):
+        from google.cloud import storage
+        from requests.adapters import HTTPAdapter
+
+        self.client = storage.Client()
+        # One client, and one pool of keep-alive connections, shared by all threads
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.client._http.mount("https://", adapter)
+        self._buckets = {}
+
+    def bucket(self, bucket_name):
+        if bucket_name not in self._buckets:
+            self._buckets[bucket_name] = self.client.bucket(bucket_name)
+        return self._buckets[bucket_name]
+
+    def download_bytes(self, bucket_name, name):
+        return self.bucket(bucket_name).blob(name).download_as_bytes()
+
+    def download_file(self, bucket_name, name, local_path):
+        self.bucket(bucket_name).blob(name).download_to_filename(local_path)
+
+    def upload_bytes(self, bucket_name, name, data, content_type="text/plain"):
+        self.bucket(bucket_name).blob(name).upload_from_string(data, content_type=content_type)
+
+    def upload_file(self, bucket_name, name, local_path):
+        self.bucket(bucket_name).blob(name).upload_from_filename(local_path)
+
+    def exists(self, bucket_name, name):
+        return self.bucket(bucket_name).blob(name).exists()
+
+    def delete(self, bucket_name, name):
+        self.bucket(bucket_name).blob(name).delete()
+
+    def list(self, bucket_name, prefix=None, page_size=1000):
+        # Pages are fetched lazily as the caller consumes the blobs
+        for blob in self.client.list_blobs(bucket_name, prefix=prefix, page_size=page_size):
+            yield BlobInfo(blob.name, blob.generation, blob.md5_hash)
+
+    def list_prefixes(self, bucket_name, prefix=None, delimiter="/"):
+        # With a delimiter GCS returns the "directories" right below prefix, not every blob in them
+        blobs = self.client.list_blobs(bucket_name, prefix=prefix, delimiter=delimiter)
+        for page in blobs.pages:
+            yield from page.prefixes
+
+
+class FilesystemBackend:
+    # Stands in for GCS in local runs and tests, each bucket is a directory under root
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, bucket_name, name):
+        return os.path.join(self.root, bucket_name, name)
+
+    def download_bytes(self, bucket_name, name):
+        with open(self.path(bucket_name, name), "rb") as f:
+            return f.read()
+
+    def download_file(self, bucket_name, name, local_path):
+        with open(local_path, "wb") as f:
+            f.write(self.download_bytes(bucket_name, name))
+
+    def upload_bytes(self, bucket_name, name, data, content_type=None):
+        path = self.path(bucket_name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data.encode("utf-8") if isinstance(data, str) else data)
+
+    def upload_file(self, bucket_name, name, local_path):
+        with open(local_path, "rb") as f:
+            self.upload_bytes(bucket_name, name, f.read())
+
+    def exists(self, bucket_name, name):
+        return os.path.isfile(self.path(bucket_name, name))
+
+    def delete(self, bucket_name, name):
+        os.remove(self.path(bucket_name, name))
+
+    def list(self, bucket_name, prefix=None, page_size=1000):
+        bucket_root = os.path.join(self.root, bucket_name)
+        # Only walk the directory the prefix points into
+        start = os.path.join(bucket_root, os.path.dirname(prefix or ""))
+        for directory, directories, files in os.walk(start):
+            directories.sort()
+            for file_name in sorted(files):
+                path = os.path.join(directory, file_name)
+                name = os.path.relpath(path, bucket_root).replace(os.sep, "/")
+                if prefix and not name.startswith(prefix):
+                    continue
+                with open(path, "rb") as f:
+                    md5 = base64.b64encode(hashlib.md5(f.read()).digest()).decode("ascii")
+                yield BlobInfo(name, os.stat(path).st_mtime_ns, md5)
+
+    def list_prefixes(self, bucket_name, prefix=None, delimiter="/"):
+        directory = os.path.join(self.root, bucket_name, os.path.dirname(prefix or ""))
+        if not os.path.isdir(directory):
+            return
+        parent = os.path.dirname(prefix or "")
+        for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+            name = f"{parent}/{entry.name}" if parent else entry.name
+            if entry.is_dir() and name.startswith(prefix or ""):
+                yield name + delimiter
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            root = os.getenv("STORAGE_ROOT")
+            _backend = FilesystemBackend(root) if root else GcsBackend()
+        return _backend
+
+
+def set_backend(backend):
+    global _backend
+    with _backend_lock:
+        _backend = backend
+
+
+def download_many(bucket_name, names, workers=16):
+    # Returns {name: bytes} for the downloads that succeeded and {name: error} for the rest
+    backend = get_backend()
+    results, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {name: executor.submit(with_retries, lambda name=name: backend.download_bytes(bucket_name, name))
+                   for name in names}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as ex:
+                logging.error(f"Error downloading {name} from GCS: {ex}")
+                errors[name] = ex
+    return results, errors
+
+
+def upload_many(bucket_name, items, workers=16):
+    # items are (name, bytes) pairs, returns {name: error} for the uploads that failed
+    backend = get_backend()
+    errors = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {name: executor.submit(with_retries, lambda name=name, data=data: backend.upload_bytes(bucket_name, name, data))
+                   for name, data in items}
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as ex:
+                logging.error(f"Error uploading {name} to GCS: {ex}")
+                errors[name] = ex
+    return errors
@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from blob_store import BlobInfo, get_backend, with_retries
+
+
+class DeadLetterQueue:
+    def __init__(self, data_bucket, all_prefix, fail_prefix, run_id, workers=4, flush_interval=60):
+        self.data_bucket = data_bucket
+        self.all_prefix = all_prefix
+        self.fail_prefix = fail_prefix
+        self.log_path = f"{fail_prefix}/errors/{run_id}.jsonl"
+        self.flush_interval = flush_interval
+        self.entries = []
+        self.closed = False
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flushed = 0
+        self._flushed_at = time.monotonic()
+        # Copies of failed images are uploaded in the background, off the stage threads
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dead-letter")
+
+    def fail_path(self, image_name):
+        return f"{self.fail_prefix}/{os.path.relpath(image_name, self.all_prefix)}"
+
+    def put(self, image, stage, error, data=None):
+        entry = {
+            "name": image.name,
+            "generation": image.generation,
+            "md5": image.md5,
+            "stage": stage,
+            "error": str(error),
+            "failed_at": datetime.datetime.now().isoformat(),
+        }
+        with self._lock:
+            self.entries.append(entry)
+            due = time.monotonic() - self._flushed_at >= self.flush_interval
+            if due:
+                self._flushed_at = time.monotonic()
+        if data is not None:
+            self._executor.submit(self._upload, image.name, data)
+        if due:
+            self._executor.submit(self._flush_in_background)
+
+    def _upload(self, image_name, data):
+        try:
+            with_retries(lambda: get_backend().upload_bytes(self.data_bucket, self.fail_path(image_name), data))
+        except Exception as ex:
+            logging.error(f"Error uploading failed image {image_name} to GCS: {ex}")
+
+    def failed_names(self):
+        with self._lock:
+            return {entry["name"] for entry in self.entries}
+
+    def flush(self):
+        # The whole log is rewritten, so a crash loses at most flush_interval seconds of entries
+        with self._flush_lock:
+            with self._lock:
+                entries = list(self.entries)
+            if len(entries) == self._flushed:
+                return
+            content = ''.join(json.dumps(entry) + '\n' for entry in entries)
+            with_retries(lambda: get_backend().upload_bytes(self.data_bucket, self.log_path, content))
+            self._flushed = len(entries)
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        except Exception as ex:
+            logging.error(f"Error writing error log {self.log_path} to GCS: {ex}")
+
+    def close(self):
+        # Safe to call again from a finally block after a normal close
+        if self.closed:
+            return
+        self.closed = True
+        self._executor.shutdown(wait=True)
+        self.flush()
+        with self._lock:
+            entries = list(self.entries)
+        if not entries:
+            return
+        stages = ", ".join(f"{stage}: {count}" for stage, count in Counter(entry["stage"] for entry in entries).items())
+        logging.info(f"Wrote {len(entries)} failed images ({stages}) to gs://{self.data_bucket}/{self.log_path}")
+
+
+def load_dead_letters(data_bucket, fail_prefix):
+    # Returns the error logs and the images they list, the latest entry per image wins
+    backend = get_backend()
+    log_paths = [blob.name for blob in backend.list(data_bucket, prefix=f"{fail_prefix}/errors/")
+                 if blob.name.endswith(".jsonl")]
+    images = {}
+    for log_path in log_paths:
+        content = with_retries(lambda: backend.download_bytes(data_bucket, log_path)).decode("utf-8")
+        for line in content.splitlines():
+            if line.strip():
+                entry = json.loads(line)
+                images[entry["name"]] = BlobInfo(entry["name"], entry["generation"], entry["md5"])
+    return log_paths, list(images.values())
+
+
+def clear_dead_letters(data_bucket, log_paths, fail_paths):
+    backend = get_backend()
+    for path in list(log_paths) + list(fail_paths):
+        try:
+            # Images that failed to download have no copy under fail_prefix
+            if with_retries(lambda: backend.exists(data_bucket, path)):
+                with_retries(lambda: backend.delete(data_bucket, path))
+        except Exception as ex:
+            logging.error(f"Error deleting {path} from GCS: {ex}")
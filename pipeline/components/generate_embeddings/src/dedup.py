@@ -0,0 +1,171 @@
+import json
+import threading
+from collections import Counter
+
+import numpy as np
+
+HASH_BITS = 64
+
+
+class HashIndex:
+    # Near-duplicate lookup over 64-bit perceptual hashes. Hashes are split into
+    # max_distance + 1 bands: two hashes within max_distance bits of each other
+    # agree exactly on at least one band, so only hashes sharing a band are compared.
+    def __init__(self, max_distance=3):
+        self.max_distance = max_distance
+        self.num_bands = max_distance + 1
+        self.band_bits = -(-HASH_BITS // self.num_bands)
+        self.bands = [dict() for _ in range(self.num_bands)]
+        self.hashes = {}
+
+    def _band_keys(self, phash):
+        mask = (1 << self.band_bits) - 1
+        return [(phash >> (band * self.band_bits)) & mask for band in range(self.num_bands)]
+
+    def find(self, phash, exclude=None):
+        # Returns (name, distance) of the closest indexed hash within max_distance, or None
+        best = None
+        for band, key in enumerate(self._band_keys(phash)):
+            for name in self.bands[band].get(key, ()):
+                if name == exclude:
+                    continue
+                distance = bin(self.hashes[name] ^ phash).count("1")
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = (name, distance)
+        return best
+
+    def add(self, name, phash):
+        if name in self.hashes:
+            # A rewritten image replaces its old hash
+            for band, key in enumerate(self._band_keys(self.hashes[name])):
+                self.bands[band][key].remove(name)
+        self.hashes[name] = phash
+        for band, key in enumerate(self._band_keys(phash)):
+            self.bands[band].setdefault(key, []).append(name)
+
+
+class EmbeddingIndex:
+    # Canonical embeddings seen so far, compared a whole batch at a time. They are kept
+    # as float16 in fixed-size chunks, about 2.8 KB per image, and growing never copies them.
+    def __init__(self, threshold=0.98, chunk_rows=8192):
+        self.threshold = threshold
+        self.chunk_rows = chunk_rows
+        self.names = []
+        self.chunks = []
+
+    def _append(self, names, vectors):
+        vectors = vectors.astype(np.float16)
+        done = 0
+        while done < len(vectors):
+            position = len(self.names) + done
+            offset = position % self.chunk_rows
+            if offset == 0:
+                self.chunks.append(np.empty((self.chunk_rows, vectors.shape[1]), dtype=np.float16))
+            count = min(len(vectors) - done, self.chunk_rows - offset)
+            self.chunks[-1][offset:offset + count] = vectors[done:done + count]
+            done += count
+        self.names.extend(names)
+
+    def _nearest(self, vectors):
+        # Best similarity and index per vector, widening one chunk at a time to float32
+        best = np.full(len(vectors), -1.0, dtype=np.float32)
+        best_index = np.full(len(vectors), -1)
+        for i, chunk in enumerate(self.chunks):
+            rows = min(self.chunk_rows, len(self.names) - i * self.chunk_rows)
+            similarities = vectors @ chunk[:rows].astype(np.float32).T
+            index = similarities.argmax(axis=1)
+            score = similarities[np.arange(len(vectors)), index]
+            better = score > best
+            best[better] = score[better]
+            best_index[better] = index[better] + i * self.chunk_rows
+        return best, best_index
+
+    def collapse(self, names, embeddings):
+        # Returns {name: (canonical name, similarity)} for the near-duplicates among names
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        best, best_index = self._nearest(vectors)
+
+        duplicates, kept = {}, []
+        for i, name in enumerate(names):
+            if best[i] >= self.threshold:
+                duplicates[name] = (self.names[best_index[i]], float(best[i]))
+                continue
+            # Within the batch, compare against the images kept so far
+            for j in kept:
+                similarity = float(vectors[i] @ vectors[j])
+                if similarity >= self.threshold:
+                    duplicates[name] = (names[j], similarity)
+                    break
+            else:
+                kept.append(i)
+
+        self._append([names[i] for i in kept], vectors[kept])
+        return duplicates
+
+
+class Deduplicator:
+    def __init__(self, max_hash_distance=3, similarity=0.98):
+        self.hash_index = HashIndex(max_hash_distance) if max_hash_distance >= 0 else None
+        self.embedding_index = EmbeddingIndex(similarity) if similarity > 0 else None
+        self.duplicates = []
+        self._lock = threading.Lock()
+
+    def seed(self, hashes):
+        # Hashes of images embedded in earlier runs, so new copies of them are skipped too
+        if self.hash_index is None:
+            return
+        with self._lock:
+            for name, phash in hashes:
+                self.hash_index.add(name, phash)
+
+    def hash_of(self, name):
+        if self.hash_index is None:
+            return None
+        with self._lock:
+            return self.hash_index.hashes.get(name)
+
+    def check_hash(self, name, phash):
+        # Before embedding: returns the canonical image name if name is a copy of one
+        if self.hash_index is None:
+            return None
+        with self._lock:
+            match = self.hash_index.find(phash, exclude=name)
+            if match is None:
+                self.hash_index.add(name, phash)
+                return None
+            canonical, distance = match
+            self.duplicates.append({"name": name, "canonical": canonical, "method": "phash",
+                                    "score": distance})
+            return canonical
+
+    def check_embeddings(self, names, embeddings):
+        # After embedding: returns {name: canonical name} for the near-duplicates in a batch
+        if self.embedding_index is None or not names:
+            return {}
+        with self._lock:
+            duplicates = self.embedding_index.collapse(names, embeddings)
+            for name, (canonical, similarity) in duplicates.items():
+                self.duplicates.append({"name": name, "canonical": canonical, "method": "cosine",
+                                        "score": round(similarity, 4)})
+        return {name: canonical for name, (canonical, _) in duplicates.items()}
+
+    def summary(self):
+        with self._lock:
+            methods = Counter(duplicate["method"] for duplicate in self.duplicates)
+        # A hash duplicate never reaches the model, neither kind reaches the index
+        return {
+            "hash_duplicates": methods["phash"],
+            "embedding_duplicates": methods["cosine"],
+            "api_calls_saved": methods["phash"],
+            "index_entries_saved": methods["phash"] + methods["cosine"],
+        }
+
+    def report(self, id_fn=lambda name: name):
+        with self._lock:
+            duplicates = list(self.duplicates)
+        return ''.join(json.dumps({
+            "id": id_fn(duplicate["name"]),
+            "canonical_id": id_fn(duplicate["canonical"]),
+            **duplicate,
+        }) + '\n' for duplicate in duplicates)
@@ -0,0 +1,98 @@
+import os
+import json
+import logging
+import argparse
+
+import numpy as np
+
+DTYPES = ["float32", "float16", "int8"]
+
+
+def shard_paths(path):
+    # A shard is an .npy matrix plus a .meta.json sidecar with ids, restricts and dtype
+    base = path[:-4] if path.endswith(".npy") else path
+    return f"{base}.npy", f"{base}.meta.json"
+
+
+def quantize(embeddings, dtype):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if dtype == "float32":
+        return embeddings, None
+    if dtype == "float16":
+        return embeddings.astype(np.float16), None
+    if dtype == "int8":
+        # Symmetric per-vector scalar quantization
+        scales = np.abs(embeddings).max(axis=1) / 127
+        scales[scales == 0] = 1
+        return np.round(embeddings / scales[:, None]).astype(np.int8), scales
+    raise ValueError(f"Unsupported dtype {dtype}, expected one of {DTYPES}")
+
+
+def write_shard(path, ids, embeddings, restricts, dtype="float32"):
+    matrix_path, sidecar_path = shard_paths(path)
+    matrix, scales = quantize(embeddings, dtype)
+    np.save(matrix_path, matrix)
+    with open(sidecar_path, "w") as f:
+        json.dump({
+            "dtype": dtype,
+            "ids": list(ids),
+            "restricts": list(restricts),
+            "scales": scales.tolist() if scales is not None else None,
+        }, f)
+    return matrix_path, sidecar_path
+
+
+def read_shard(path, mmap=True, dequantize=True):
+    matrix_path, sidecar_path = shard_paths(path)
+    with open(sidecar_path) as f:
+        sidecar = json.load(f)
+    matrix = np.load(matrix_path, mmap_mode="r" if mmap else None)
+    if dequantize and sidecar["dtype"] == "int8":
+        matrix = matrix.astype(np.float32) * np.asarray(sidecar["scales"], dtype=np.float32)[:, None]
+    elif dequantize and sidecar["dtype"] == "float16":
+        matrix = matrix.astype(np.float32)
+    return sidecar["ids"], sidecar["restricts"], matrix
+
+
+def jsonl_to_shard(jsonl_path, path, dtype="float32"):
+    ids, embeddings, restricts = [], [], []
+    with open(jsonl_path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            datapoint = json.loads(line)
+            ids.append(datapoint["id"])
+            embeddings.append(datapoint["embedding"])
+            restricts.append(datapoint.get("restricts", []))
+    return write_shard(path, ids, embeddings, restricts, dtype)
+
+
+def shard_to_jsonl(path, jsonl_path):
+    ids, restricts, matrix = read_shard(path)
+    with open(jsonl_path, "w") as f:
+        for i, image_id in enumerate(ids):
+            datapoint = {"id": image_id, "embedding": matrix[i].tolist()}
+            if restricts[i]:
+                datapoint["restricts"] = restricts[i]
+            f.write(json.dumps(datapoint) + "\n")
+    return jsonl_path
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['to-npy', 'to-jsonl'], help='Conversion direction.')
+    parser.add_argument('--input', type=str, nargs='+', required=True, help='Files to convert.')
+    parser.add_argument('--output_dir', type=str, required=True, help='Directory for converted files.')
+    parser.add_argument('--dtype', type=str, default='float32', choices=DTYPES, help='Shard dtype for to-npy.')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for input_path in args.input:
+        name = os.path.splitext(os.path.basename(input_path))[0]
+        if args.command == 'to-npy':
+            jsonl_to_shard(input_path, os.path.join(args.output_dir, name), args.dtype)
+        else:
+            shard_to_jsonl(input_path, os.path.join(args.output_dir, f"{name}.json"))
+        logging.info(f"Converted {input_path}")
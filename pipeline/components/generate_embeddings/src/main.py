@@ -4,59 +4,302 @@ import datetime
 import json
 import utils
 import google.cloud.logging
-from utils import list_gcs_directories, list_gcs_files, download_from_gcs, upload_to_gcs, is_file_empty, resize_image
+from collections import defaultdict
+from utils import list_gcs_directories, list_gcs_images, list_gcs_files, download_bytes_from_gcs, upload_to_gcs, upload_bytes_to_gcs, delete_from_gcs
+from stages import Stage, Pipeline
+from preprocess import preprocess_and_hash, thumbnail_only
+from dedup import Deduplicator
+from manifest import Manifest
+from embedding_client import EmbeddingClient
+from blob_store import BlobInfo
+from dead_letter import DeadLetterQueue, load_dead_letters, clear_dead_letters
+from embedding_format import write_shard, shard_paths, DTYPES
 from google.cloud import storage, aiplatform
 from vertexai.preview.vision_models import MultiModalEmbeddingModel, Image
 from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import argparse
 
 client = google.cloud.logging.Client()
 client.setup_logging()
 
+THUMBNAIL_FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
 
-def process_image_batch(batch, all_prefix, fail_prefix, data_bucket):
-    embeddings = []
-    for search_image in batch:
-        try:
-            resize_image(search_image)
-            image = Image.load_from_file(search_image)
-            emb = multimodalembedding.get_embeddings(
-                image=image,
-            )
-            embeddings.append(emb.image_embedding)
-        except Exception as ex:
-            logging.error(f"Error processing image {search_image}: {ex}")
-            upload_to_gcs(data_bucket,
-                        f"{fail_prefix}/{os.path.relpath(search_image, all_prefix)}",
-                        search_image)
-    return embeddings
-
-
-def process(batch, category, file_name, all_prefix, fail_prefix, vertex_bucket, data_bucket):
-    embeddings = process_image_batch(batch, all_prefix, fail_prefix, data_bucket)
-    logging.info(f'Successfully processed {len(embeddings)} images')
-
-    with open(file_name, 'w') as f:
-        for i, embedding in enumerate(embeddings):
-            if embedding is None:
-                continue
-
-            f.write(json.dumps({
-                "id": os.path.basename(batch[i])[:-4],
-                "embedding": embedding,
-                "restricts": [
-                    {
-                        "namespace": "category",
-                        "allow": [category],
-                    }
-                ]
-            }) + '\n')
-
-    if is_file_empty(file_name):
+
+def get_category(image_path):
+    return os.path.basename(os.path.dirname(image_path))
+
+
+def get_image_id(image_path):
+    return os.path.basename(image_path)[:-4]
+
+
+def get_thumbnail_path(image_path):
+    # Keyed by the datapoint id alone, so the app builds thumbnail URLs from a match without a lookup
+    return f"{thumbnail_prefix}/{get_image_id(image_path)}.{thumbnail_format}"
+
+
+def download_image(image, data_bucket):
+    return image, download_bytes_from_gcs(image.name, data_bucket)
+
+
+def resize(item):
+    # Decoding and resizing is CPU bound, the stage threads only hand images to the process pool
+    image, data = item
+    data, phash, thumbnail = preprocess_pool.submit(preprocess_and_hash, data,
+                                                    thumbnail_size=thumbnail_size if thumbnail_prefix else 0,
+                                                    thumbnail_format=THUMBNAIL_FORMATS[thumbnail_format][0]).result()
+    return image, data, phash, thumbnail
+
+
+def skip_copies(item):
+    # Exact and near-exact copies of an image already seen are never sent to the model
+    image, data, phash, thumbnail = item
+    canonical = deduplicator.check_hash(image.name, phash)
+    if canonical is None:
+        return image, data, thumbnail
+    if manifest is not None:
+        manifest.record_duplicate(image, canonical)
+    return None
+
+
+def backfill_thumbnail(item):
+    # Images the manifest skips are not resized, so their missing thumbnails are made on their own
+    image, data = item
+    thumbnail = preprocess_pool.submit(thumbnail_only, data, thumbnail_size,
+                                       THUMBNAIL_FORMATS[thumbnail_format][0]).result()
+    return image, data, thumbnail
+
+
+def upload_thumbnail(item, data_bucket):
+    image, data, thumbnail = item
+    if thumbnail is not None:
+        upload_bytes_to_gcs(data_bucket, get_thumbnail_path(image.name), thumbnail,
+                            content_type=THUMBNAIL_FORMATS[thumbnail_format][1])
+    return image, data
+
+
+def embed_image(item):
+    image, data = item
+    emb = multimodalembedding.get_embeddings(
+        image=Image(image_bytes=data),
+    )
+    if emb.image_embedding is None:
+        raise ValueError("The model returned no image embedding")
+    return image, emb.image_embedding
+
+
+def dead_letter(stage):
+    # Every failed image becomes one dead-letter entry, tagged with the stage it failed in
+    def on_error(item, ex):
+        if stage == "download":
+            dead_letters.put(item, stage, ex)
+        elif stage == "write":
+            records, _, _ = item
+            for image, _ in records:
+                dead_letters.put(image, stage, ex)
+        else:
+            image, data = item[0], item[1]
+            dead_letters.put(image, stage, ex, data)
+    return on_error
+
+
+class BatchCollector:
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.batches = defaultdict(list)
+        self.batch_counts = defaultdict(int)
+        self.started_at = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+
+    def _emit(self, category):
+        records, self.batches[category] = self.batches[category], []
+        file_name = f'{self.started_at}_{category}_batch_{self.batch_counts[category]}.json'
+        self.batch_counts[category] += 1
+        return records, category, file_name
+
+    def add(self, record):
+        category = get_category(record[0].name)
+        self.batches[category].append(record)
+        if len(self.batches[category]) >= self.batch_size:
+            return self._emit(category)
+        return None
+
+    def flush(self):
+        return [self._emit(category) for category, records in self.batches.items() if records]
+
+
+def collapse_duplicates(batch):
+    # Near-duplicates by embedding (crops, recolored scans) stay out of the index
+    records, category, file_name = batch
+    duplicates = deduplicator.check_embeddings([image.name for image, _ in records],
+                                               [embedding for _, embedding in records])
+    if manifest is not None:
+        for image, _ in records:
+            if image.name in duplicates:
+                manifest.record_duplicate(image, duplicates[image.name])
+    records = [(image, embedding) for image, embedding in records if image.name not in duplicates]
+    return (records, category, file_name) if records else None
+
+
+def get_restricts(categories):
+    return [
+        {
+            "namespace": "category",
+            "allow": categories,
+        }
+    ]
+
+
+def get_allowed_categories(image_name, duplicates):
+    # A copy filed under another genre is not indexed, its canonical image is found under that genre too
+    category = get_category(image_name)
+    return [category] + sorted({get_category(name) for name in duplicates.get(image_name, [])} - {category})
+
+
+def write_shard_to_gcs(file_name, ids, embeddings, restricts, vertex_bucket):
+    shard_files = write_shard(file_name[:-5], ids, embeddings, restricts, dtype=shard_dtype)
+    for shard_file in shard_files:
+        upload_to_gcs(vertex_bucket, f"{shard_prefix}/{shard_file}", shard_file)
+        os.remove(shard_file)
+
+
+def process(records, category, file_name, vertex_bucket):
+    # records are (image, embedding) pairs, so an id always travels with its own vector.
+    # Duplicates recorded later are added to the restricts when the file is compacted.
+    duplicates = manifest.duplicates_of([image.name for image, _ in records]) if manifest is not None else {}
+    restricts = [get_restricts(get_allowed_categories(image.name, duplicates)) for image, _ in records]
+    content = ''.join(json.dumps({
+        "id": get_image_id(image.name),
+        "embedding": embedding,
+        "restricts": image_restricts
+    }) + '\n' for (image, embedding), image_restricts in zip(records, restricts))
+
+    if not content:
         raise ValueError(f"{file_name} is empty")
 
-    upload_to_gcs(vertex_bucket, f"{idx_prefix}/{file_name}", file_name)
-    logging.info(f'Successfully uploaded embeddings to GCS: {file_name}')
+    upload_bytes_to_gcs(vertex_bucket, f"{idx_prefix}/{file_name}", content)
+    if delta_prefix:
+        upload_bytes_to_gcs(vertex_bucket, f"{delta_prefix}/{file_name}", content)
+    if shard_prefix:
+        write_shard_to_gcs(file_name,
+                           [get_image_id(image.name) for image, _ in records],
+                           [embedding for _, embedding in records],
+                           restricts,
+                           vertex_bucket)
+    logging.info(f'Successfully uploaded {len(records)} embeddings to GCS: {file_name}')
+
+    if manifest is not None:
+        manifest.record([image for image, _ in records], file_name,
+                        hashes=[deduplicator.hash_of(image.name) for image, _ in records])
+        manifest.save(vertex_bucket, manifest_path, min_interval=60)
+
+
+def list_images(data_bucket):
+    # Stream the category directories under all_prefix, then their images page by page,
+    # so embedding starts with the first page instead of after the whole listing
+    for directory in list_gcs_directories(data_bucket, all_prefix):
+        logging.info(f"Processing images in directory: {directory}")
+        yield from list_gcs_images(data_bucket, directory, page_size=list_page_size)
+
+
+def list_thumbnails(data_bucket):
+    extension = f".{thumbnail_format}"
+    return {os.path.basename(name)[:-len(extension)]
+            for name in list_gcs_files(data_bucket, thumbnail_prefix, allowed_extensions=[extension])}
+
+
+def list_changed_images(data_bucket, seen_names, thumbnails=None, missing_thumbnails=None):
+    # Skipped images without a thumbnail go to missing_thumbnails, duplicates show their canonical's
+    skipped = 0
+    for image in list_images(data_bucket):
+        seen_names.add(image.name)
+        if manifest.is_current(image):
+            skipped += 1
+            if (thumbnails is not None and get_image_id(image.name) not in thumbnails
+                    and not manifest.is_duplicate(image.name)):
+                missing_thumbnails.append(image)
+            continue
+        yield image
+    logging.info(f"Skipped {skipped} images already embedded according to the manifest")
+
+
+def backfill_thumbnails(images, data_bucket, download_workers, resize_workers):
+    logging.info(f"Making thumbnails for {len(images)} embedded images that have none")
+    Pipeline([
+        Stage("download", partial(download_image, data_bucket=data_bucket), workers=download_workers),
+        Stage("resize", backfill_thumbnail, workers=resize_workers),
+        Stage("thumbnail", partial(upload_thumbnail, data_bucket=data_bucket), workers=download_workers),
+    ]).run(images)
+
+
+def list_dead_letters(data_bucket):
+    log_paths, images = load_dead_letters(data_bucket, fail_prefix)
+    logging.info(f"Retrying {len(images)} failed images from {len(log_paths)} error logs")
+    return log_paths, images
+
+
+def write_deletes(image_names, run_id, vertex_bucket):
+    # Vertex AI removes the datapoints listed in the delete/ folder of a delta update.
+    file_name = f"{run_id}_deleted.txt"
+    content = ''.join(get_image_id(image_name) + '\n' for image_name in image_names)
+    upload_bytes_to_gcs(vertex_bucket, f"{delta_prefix}/delete/{file_name}", content)
+    logging.info(f'Uploaded {len(image_names)} deletions to GCS: {file_name}')
+
+
+def rewrite_index_file(file_name, vertex_bucket):
+    # Keeps only the datapoints of the images the manifest still assigns to this file,
+    # with the genres of their current duplicates in the restricts
+    names = {get_image_id(name): name for name in manifest.names_in(file_name)}
+    if not names:
+        delete_from_gcs(vertex_bucket, f"{idx_prefix}/{file_name}")
+        if shard_prefix:
+            for shard_file in shard_paths(file_name[:-5]):
+                delete_from_gcs(vertex_bucket, f"{shard_prefix}/{shard_file}")
+        logging.info(f"Removed {file_name}, none of its images are current")
+        return
+
+    content = download_bytes_from_gcs(f"{idx_prefix}/{file_name}", vertex_bucket).decode("utf-8")
+    datapoints = [json.loads(line) for line in content.splitlines() if line.strip()]
+    duplicates = manifest.duplicates_of(names.values())
+    kept = [{**datapoint, "restricts": get_restricts(get_allowed_categories(names[datapoint["id"]], duplicates))}
+            for datapoint in datapoints if datapoint["id"] in names]
+    if kept == datapoints:
+        return
+
+    content = ''.join(json.dumps(datapoint) + '\n' for datapoint in kept)
+    upload_bytes_to_gcs(vertex_bucket, f"{idx_prefix}/{file_name}", content)
+    if delta_prefix:
+        upload_bytes_to_gcs(vertex_bucket, f"{delta_prefix}/{file_name}", content)
+    if shard_prefix:
+        write_shard_to_gcs(file_name,
+                           [datapoint["id"] for datapoint in kept],
+                           [datapoint["embedding"] for datapoint in kept],
+                           [datapoint["restricts"] for datapoint in kept],
+                           vertex_bucket)
+    logging.info(f"Rewrote {file_name} with {len(kept)} of its {len(datapoints)} embeddings")
+
+
+def compact_index(vertex_bucket):
+    # idx_prefix is left holding exactly the datapoints the manifest lists, so building
+    # or fully updating an index from it neither restores deleted images nor loads an id twice.
+    # Files no manifest row points to are left over from a crashed run or a run without a manifest.
+    listed = {os.path.basename(name) for name in list_gcs_files(vertex_bucket, idx_prefix, ['.json'])
+              if os.path.dirname(name) == idx_prefix}
+    stale = manifest.stale_files()
+    for file_name in sorted((listed - manifest.embedding_files()) | (stale & listed)):
+        rewrite_index_file(file_name, vertex_bucket)
+    manifest.clear_stale()
+
+
+def write_dedup_report(run_id, vertex_bucket):
+    summary = deduplicator.summary()
+    logging.info(f"Deduplication: {summary['hash_duplicates']} copies skipped before embedding, "
+                 f"{summary['embedding_duplicates']} near-duplicates collapsed after embedding, "
+                 f"{summary['api_calls_saved']} API calls and {summary['index_entries_saved']} index entries saved")
+    if not dedup_prefix or not deduplicator.duplicates:
+        return
+    upload_bytes_to_gcs(vertex_bucket, f"{dedup_prefix}/{run_id}_summary.json", json.dumps(summary))
+    upload_bytes_to_gcs(vertex_bucket, f"{dedup_prefix}/{run_id}_duplicates.jsonl", deduplicator.report(get_image_id))
 
 
 if __name__ == '__main__':
@@ -68,6 +311,25 @@ if __name__ == '__main__':
     parser.add_argument('--all_prefix', type=str, required=True, help='Prefix for all images.')
     parser.add_argument('--idx_prefix', type=str, required=True, help='Prefix for index files.')
     parser.add_argument('--fail_prefix', type=str, required=True, help='Prefix for failed images.')
+    parser.add_argument('--mode', type=str, default='embed', choices=['embed', 'retry_failed'], help='Embed the bucket, or only the images in the dead-letter logs.')
+    parser.add_argument('--manifest_path', type=str, default='manifest/manifest.db', help='Manifest path in the vertex bucket, empty for a full run.')
+    parser.add_argument('--delta_prefix', type=str, default='delta', help='Prefix for incremental index updates, empty to disable.')
+    parser.add_argument('--shard_prefix', type=str, default='', help='Prefix for binary .npy embedding shards, empty to disable.')
+    parser.add_argument('--shard_dtype', type=str, default='float32', choices=DTYPES, help='Element type of the binary shards.')
+    parser.add_argument('--dedup_hash_distance', type=int, default=3, help='Max differing bits of the perceptual hash for a copy, -1 to disable.')
+    parser.add_argument('--dedup_similarity', type=float, default=0.98, help='Cosine similarity that makes a near-duplicate, 0 to disable.')
+    parser.add_argument('--dedup_prefix', type=str, default='dedup', help='Prefix for deduplication reports, empty to disable.')
+    parser.add_argument('--thumbnail_prefix', type=str, default='thumbnails', help='Prefix for thumbnails in the data bucket, empty to disable.')
+    parser.add_argument('--thumbnail_size', type=int, default=256, help='Longest side of the thumbnails in pixels.')
+    parser.add_argument('--thumbnail_format', type=str, default='webp', choices=list(THUMBNAIL_FORMATS), help='Thumbnail image format.')
+    parser.add_argument('--batch_size', type=int, default=100, help='Embeddings per output file.')
+    parser.add_argument('--download_workers', '--download-workers', type=int, default=16, help='Parallel image downloads.')
+    parser.add_argument('--resize_workers', '--resize-workers', type=int, default=os.cpu_count(), help='Image preprocessing processes.')
+    parser.add_argument('--embed_concurrency', '--embed-concurrency', type=int, default=8, help='Maximum concurrent embedding requests.')
+    parser.add_argument('--embed_rate', '--embed-rate', type=float, default=0, help='Embedding requests per second, 0 for no limit.')
+    parser.add_argument('--write_workers', '--write-workers', type=int, default=2, help='Parallel embedding file uploads.')
+    parser.add_argument('--list_page_size', '--list-page-size', type=int, default=1000, help='Blobs fetched per listing request.')
+    parser.add_argument('--queue_size', '--queue-size', type=int, default=200, help='Bound of the queue between stages.')
     args = parser.parse_args()
 
     project_id = args.project_id
@@ -77,45 +339,116 @@ if __name__ == '__main__':
     all_prefix = args.all_prefix
     idx_prefix = args.idx_prefix
     fail_prefix = args.fail_prefix
+    manifest_path = args.manifest_path
+    delta_prefix = args.delta_prefix
+    shard_prefix = args.shard_prefix
+    shard_dtype = args.shard_dtype
+    list_page_size = args.list_page_size
+    dedup_prefix = args.dedup_prefix
+    thumbnail_prefix = args.thumbnail_prefix
+    thumbnail_size = args.thumbnail_size
+    thumbnail_format = args.thumbnail_format
 
     aiplatform.init(project=project_id, location=location)
-    multimodalembedding = MultiModalEmbeddingModel.from_pretrained("multimodalembedding@001")
+    # Requests are paced to the quota and concurrency backs off on 429/5xx, so throttling costs time, not images
+    multimodalembedding = EmbeddingClient(MultiModalEmbeddingModel.from_pretrained("multimodalembedding@001"),
+                                          rate=args.embed_rate,
+                                          max_concurrency=args.embed_concurrency)
 
+    dead_letters = None
     try:
-        batch_size = 100
+        manifest = None
+        if manifest_path:
+            manifest = Manifest.load(vertex_bucket, manifest_path, os.path.basename(manifest_path))
+            logging.info(f"Manifest lists {len(manifest)} embedded images")
+
+        deduplicator = Deduplicator(args.dedup_hash_distance, args.dedup_similarity)
+        if manifest is not None:
+            deduplicator.seed(manifest.hashes())
+        collector = BatchCollector(args.batch_size)
+        dead_letters = DeadLetterQueue(data_bucket, all_prefix, fail_prefix, collector.started_at)
+
+        preprocess_pool = ProcessPoolExecutor(max_workers=args.resize_workers)
+        # Fork the worker processes now, before the stage threads are running
+        preprocess_pool.submit(int).result()
 
-        # List all directories in the data bucket
-        directories = list_gcs_directories(data_bucket)
+        # Download, resize, embed and write run concurrently, connected by bounded queues
+        write_stage = Stage("write", lambda batch: process(*batch, vertex_bucket), workers=args.write_workers,
+                            on_error=dead_letter("write"), size=lambda batch: len(batch[0]))
+        pipeline = Pipeline([
+            Stage("download", partial(download_image, data_bucket=data_bucket), workers=args.download_workers,
+                  on_error=dead_letter("download")),
+            Stage("resize", resize, workers=args.resize_workers, on_error=dead_letter("resize")),
+            Stage("dedup", skip_copies, on_error=dead_letter("dedup")),
+            Stage("thumbnail", partial(upload_thumbnail, data_bucket=data_bucket), workers=args.download_workers,
+                  on_error=dead_letter("thumbnail")),
+            Stage("embed", embed_image, workers=args.embed_concurrency, on_error=dead_letter("embed"),
+                  stats=multimodalembedding.stats),
+            Stage("batch", collector.add, on_close=collector.flush),
+            Stage("collapse", collapse_duplicates, size=lambda batch: len(batch[0])),
+            write_stage,
+        ], queue_size=args.queue_size)
 
-        for directory in directories:
-            if not os.path.exists(directory):
-                os.makedirs(directory)
-                
-            logging.info(f"Processing images in directory: {directory}")
+        seen_names = set()
+        missing_thumbnails = []
+        if args.mode == 'retry_failed':
+            retried_logs, images = list_dead_letters(data_bucket)
+        elif manifest is not None:
+            thumbnails = list_thumbnails(data_bucket) if thumbnail_prefix else None
+            images = list_changed_images(data_bucket, seen_names, thumbnails, missing_thumbnails)
+        else:
+            images = list_images(data_bucket)
+        pipeline.run(images)
+        dead_letters.close()
+        write_dedup_report(collector.started_at, vertex_bucket)
 
-            # List all files in the current directory
-            files_list = list_gcs_files(data_bucket, directory)
+        if args.mode == 'retry_failed':
+            # Recovered images leave the dead-letter set, the ones that failed again are in the new log
+            failed_again = dead_letters.failed_names()
+            recovered = [image.name for image in images if image.name not in failed_again]
+            clear_dead_letters(data_bucket, retried_logs, [dead_letters.fail_path(name) for name in recovered])
+            logging.info(f"Recovered {len(recovered)} of {len(images)} failed images")
 
-            # Download and process images in batches
-            for i in range(0, len(files_list), batch_size):
-                batch = files_list[i:i + batch_size]
+        if write_stage.failed:
+            raise RuntimeError(f"Failed to write {write_stage.failed} embedding files")
 
-                # Download images
-                for image_path in batch:
-                    download_from_gcs(image_path, data_bucket)
-                logging.info(f'Successfully downloaded {len(batch)} images')
+        if manifest is not None:
+            # A retry run only sees the failed images, so it cannot tell which images were deleted
+            deleted = manifest.missing(seen_names) if args.mode == 'embed' else []
+            # Duplicates were never indexed, and may share their id with the canonical image
+            indexed = [name for name in deleted if not manifest.is_duplicate(name)]
+            manifest.remove(deleted)
+            # Indexed images edited into copies of another image lost their datapoint too.
+            # An id another indexed image still has stays, with that image's thumbnail.
+            owners = {get_image_id(name): name for name in manifest.indexed_names()}
+            unindexed = manifest.unindexed()
+            dropped = [name for name in indexed + unindexed if get_image_id(name) not in owners]
+            if dropped and delta_prefix:
+                write_deletes(dropped, collector.started_at, vertex_bucket)
+            if thumbnail_prefix:
+                for name in dropped:
+                    delete_from_gcs(data_bucket, get_thumbnail_path(name))
+                missing_thumbnails += [BlobInfo(owners[image_id], None, None)
+                                       for image_id in {get_image_id(name) for name in unindexed} & owners.keys()]
+            manifest.clear_unindexed()
 
-                # Process and upload embeddings
-                current_datetime = datetime.datetime.now()
-                formatted_datetime = current_datetime.strftime('%Y-%m-%d_%H-%M-%S')
-                category = os.path.basename(directory)  # Use the directory name as the category
-                file_name = f'{formatted_datetime}_{category}_batch_{i // batch_size}.json'
-                process(batch, category, file_name, all_prefix, fail_prefix, vertex_bucket, data_bucket)
+        if missing_thumbnails:
+            # Failures are only logged, the next run finds the thumbnails still missing
+            backfill_thumbnails(missing_thumbnails, data_bucket, args.download_workers, args.resize_workers)
+        preprocess_pool.shutdown()
 
-                # Remove downloaded images to free up memory
-                for image_path in batch:
-                    os.remove(image_path)
+        if manifest is not None:
+            manifest.remove_orphan_duplicates()
+            compact_index(vertex_bucket)
+            manifest.save(vertex_bucket, manifest_path)
 
     except Exception as ex:
         logging.error(f"Error in main process: {ex}")
-        raise
\ No newline at end of file
+        raise
+    finally:
+        # The error log is what --mode retry_failed reads, it is written even when the run crashes
+        if dead_letters is not None:
+            try:
+                dead_letters.close()
+            except Exception as ex:
+                logging.error(f"Error writing the error log: {ex}")
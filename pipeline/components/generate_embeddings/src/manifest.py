@@ -0,0 +1,192 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+from utils import upload_to_gcs, gcs_file_exists
+from blob_store import get_backend, with_retries
+
+
+class Manifest:
+    def __init__(self, local_path):
+        self.local_path = local_path
+        self.connection = sqlite3.connect(local_path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+                name TEXT PRIMARY KEY,
+                generation INTEGER,
+                md5 TEXT,
+                embedding_file TEXT,
+                updated_at REAL,
+                phash TEXT,
+                canonical TEXT
+            )""")
+        # Embedding files that hold rows of re-embedded or removed images until they are compacted
+        self.connection.execute("CREATE TABLE IF NOT EXISTS stale_files (embedding_file TEXT PRIMARY KEY)")
+        # Canonical images whose duplicates changed, their datapoints need new restricts
+        self.connection.execute("CREATE TABLE IF NOT EXISTS stale_canonicals (name TEXT PRIMARY KEY)")
+        # Indexed images that turned into duplicates, their datapoints must be deleted from the index
+        self.connection.execute("CREATE TABLE IF NOT EXISTS unindexed (name TEXT PRIMARY KEY)")
+        # Manifests written before deduplication lack the last two columns
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(images)")}
+        for column in ("phash", "canonical"):
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE images ADD COLUMN {column} TEXT")
+        self.connection.commit()
+        self._lock = threading.Lock()
+        self._saved_at = time.monotonic()
+
+    @classmethod
+    def load(cls, bucket_name, gcs_path, local_path):
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        if gcs_file_exists(bucket_name, gcs_path):
+            # A failed download must stop the run, an empty manifest would re-embed
+            # everything and then overwrite the one in the bucket
+            with_retries(lambda: get_backend().download_file(bucket_name, gcs_path, local_path))
+            logging.info(f"Loaded manifest from gs://{bucket_name}/{gcs_path}")
+        else:
+            logging.info(f"No manifest at gs://{bucket_name}/{gcs_path}, starting a full run")
+        return cls(local_path)
+
+    def save(self, bucket_name, gcs_path, min_interval=0):
+        with self._lock:
+            if time.monotonic() - self._saved_at < min_interval:
+                return
+            self.connection.commit()
+            upload_to_gcs(bucket_name, gcs_path, self.local_path)
+            self._saved_at = time.monotonic()
+
+    def __len__(self):
+        with self._lock:
+            return self.connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def is_current(self, image):
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT generation, md5 FROM images WHERE name = ?", (image.name,)).fetchone()
+        # md5 identifies the content, the generation changes on every rewrite of the blob.
+        return row is not None and (row[1] == image.md5 if image.md5 else row[0] == image.generation)
+
+    def _mark_stale(self, names):
+        # The files the rows of names point to are about to hold outdated datapoints,
+        # and the canonical images of the duplicates among them lose a category
+        names = list(names)
+        for start in range(0, len(names), 500):
+            chunk = names[start:start + 500]
+            placeholders = ', '.join(['?'] * len(chunk))
+            self.connection.execute(
+                "INSERT OR IGNORE INTO stale_files SELECT DISTINCT embedding_file FROM images "
+                f"WHERE embedding_file IS NOT NULL AND name IN ({placeholders})", chunk)
+            self.connection.execute(
+                "INSERT OR IGNORE INTO stale_canonicals SELECT DISTINCT canonical FROM images "
+                f"WHERE canonical IS NOT NULL AND name IN ({placeholders})", chunk)
+
+    def record(self, images, embedding_file, hashes=None):
+        now = time.time()
+        hashes = hashes or [None] * len(images)
+        with self._lock:
+            self._mark_stale(image.name for image in images)
+            self.connection.executemany("DELETE FROM unindexed WHERE name = ?", [(image.name,) for image in images])
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, NULL)",
+                [(image.name, image.generation, image.md5, embedding_file, now,
+                  format(phash, "016x") if phash is not None else None)
+                 for image, phash in zip(images, hashes)])
+            self.connection.commit()
+
+    def record_duplicate(self, image, canonical):
+        # Duplicates count as current, but they have no embedding file of their own
+        with self._lock:
+            self._mark_stale([image.name])
+            self.connection.execute(
+                "INSERT OR IGNORE INTO unindexed SELECT name FROM images "
+                "WHERE name = ? AND embedding_file IS NOT NULL", (image.name,))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?, NULL, ?, NULL, ?)",
+                (image.name, image.generation, image.md5, time.time(), canonical))
+            self.connection.execute("INSERT OR IGNORE INTO stale_canonicals VALUES (?)", (canonical,))
+            self.connection.commit()
+
+    def hashes(self):
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT name, phash FROM images WHERE phash IS NOT NULL AND canonical IS NULL").fetchall()
+        return [(name, int(phash, 16)) for name, phash in rows]
+
+    def is_duplicate(self, name):
+        with self._lock:
+            row = self.connection.execute("SELECT canonical FROM images WHERE name = ?", (name,)).fetchone()
+        return row is not None and row[0] is not None
+
+    def remove_orphan_duplicates(self):
+        # A duplicate whose canonical image was not embedded (or is gone) must be embedded itself next run
+        with self._lock:
+            removed = self.connection.execute(
+                "DELETE FROM images WHERE canonical IS NOT NULL AND canonical NOT IN "
+                "(SELECT name FROM images WHERE embedding_file IS NOT NULL)").rowcount
+            self.connection.commit()
+        return removed
+
+    def missing(self, seen_names):
+        with self._lock:
+            names = [row[0] for row in self.connection.execute("SELECT name FROM images")]
+        return [name for name in names if name not in seen_names]
+
+    def remove(self, names):
+        with self._lock:
+            self._mark_stale(names)
+            self.connection.executemany("DELETE FROM images WHERE name = ?", [(name,) for name in names])
+            self.connection.commit()
+
+    def embedding_files(self):
+        with self._lock:
+            return {row[0] for row in self.connection.execute(
+                "SELECT DISTINCT embedding_file FROM images WHERE embedding_file IS NOT NULL")}
+
+    def indexed_names(self):
+        with self._lock:
+            return [row[0] for row in self.connection.execute(
+                "SELECT name FROM images WHERE embedding_file IS NOT NULL")]
+
+    def unindexed(self):
+        with self._lock:
+            return [row[0] for row in self.connection.execute("SELECT name FROM unindexed")]
+
+    def clear_unindexed(self):
+        # Called once their deletions are written to the delta
+        with self._lock:
+            self.connection.execute("DELETE FROM unindexed")
+            self.connection.commit()
+
+    def names_in(self, embedding_file):
+        with self._lock:
+            return [row[0] for row in self.connection.execute(
+                "SELECT name FROM images WHERE embedding_file = ?", (embedding_file,))]
+
+    def duplicates_of(self, names):
+        # Returns {canonical name: [duplicate names]} for the names that have duplicates
+        names = list(names)
+        duplicates = {}
+        with self._lock:
+            for start in range(0, len(names), 500):
+                chunk = names[start:start + 500]
+                for name, canonical in self.connection.execute(
+                        "SELECT name, canonical FROM images "
+                        f"WHERE canonical IN ({', '.join(['?'] * len(chunk))})", chunk):
+                    duplicates.setdefault(canonical, []).append(name)
+        return duplicates
+
+    def stale_files(self):
+        with self._lock:
+            return {row[0] for row in self.connection.execute(
+                "SELECT embedding_file FROM stale_files UNION "
+                "SELECT embedding_file FROM images WHERE embedding_file IS NOT NULL "
+                "AND name IN (SELECT name FROM stale_canonicals)")}
+
+    def clear_stale(self):
+        # Called once the run's files are compacted, when no batch is being written
+        with self._lock:
+            self.connection.execute("DELETE FROM stale_files")
+            self.connection.execute("DELETE FROM stale_canonicals")
+            self.connection.commit()
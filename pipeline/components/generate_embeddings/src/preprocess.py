@@ -0,0 +1,70 @@
+import logging
+from io import BytesIO
+from PIL import Image as PILImage
+
+MAX_SIZE = 1024
+HASH_SIZE = 8
+ENCODABLE_FORMATS = ("JPEG", "PNG")
+
+
+def image_hash(im, size=HASH_SIZE):
+    # dHash: one bit per pair of horizontally adjacent pixels of a tiny grayscale copy,
+    # stable under rescaling and recompression
+    small = im.convert("L").resize((size + 1, size), PILImage.BILINEAR, reducing_gap=2.0)
+    pixels = small.tobytes()
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            offset = row * (size + 1) + col
+            bits = bits << 1 | (pixels[offset] > pixels[offset + 1])
+    return bits
+
+
+def make_thumbnail(im, size, format="WEBP", quality=80):
+    thumbnail = im.convert("RGB") if im.mode != "RGB" else im.copy()
+    thumbnail.thumbnail((size, size), PILImage.LANCZOS)
+    buffer = BytesIO()
+    thumbnail.save(buffer, format=format, quality=quality)
+    return buffer.getvalue()
+
+
+def thumbnail_only(data, thumbnail_size, thumbnail_format="WEBP"):
+    # Runs in the preprocessing process pool for images that are embedded but have no thumbnail yet
+    try:
+        with PILImage.open(BytesIO(data)) as im:
+            im.draft("RGB", (thumbnail_size, thumbnail_size))
+            return make_thumbnail(im, thumbnail_size, thumbnail_format)
+    except Exception as ex:
+        logging.error(f"Error making thumbnail: {ex}")
+        raise
+
+
+def preprocess_and_hash(data, max_size=MAX_SIZE, quality=90, thumbnail_size=0, thumbnail_format="WEBP"):
+    # Runs in the preprocessing process pool, so it only depends on PIL.
+    # Returns the image to embed, its perceptual hash and a thumbnail, None if thumbnail_size is 0.
+    try:
+        with PILImage.open(BytesIO(data)) as im:
+            if max(im.size) <= max_size and im.format in ENCODABLE_FORMATS:
+                # The hash and the thumbnail only need a reduced decode
+                im.draft("RGB", (thumbnail_size or 64, thumbnail_size or 64))
+                thumbnail = make_thumbnail(im, thumbnail_size, thumbnail_format) if thumbnail_size else None
+                return data, image_hash(im), thumbnail
+
+            # For JPEGs the decoder scales down by 1/2, 1/4 or 1/8 while decoding,
+            # to the smallest size that is still at least max_size
+            im.draft("RGB", (max_size, max_size))
+            if im.mode not in ("RGB", "L"):
+                im = im.convert("RGB")
+            im.thumbnail((max_size, max_size), PILImage.LANCZOS)
+
+            buffer = BytesIO()
+            im.save(buffer, format="JPEG", quality=quality)
+            thumbnail = make_thumbnail(im, thumbnail_size, thumbnail_format) if thumbnail_size else None
+            return buffer.getvalue(), image_hash(im), thumbnail
+    except Exception as ex:
+        logging.error(f"Error preprocessing image: {ex}")
+        raise
+
+
+def preprocess_image(data, max_size=MAX_SIZE, quality=90):
+    return preprocess_and_hash(data, max_size, quality)[0]
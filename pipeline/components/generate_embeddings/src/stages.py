@@ -0,0 +1,117 @@
+import time
+import queue
+import logging
+import threading
+
+STOP = object()
+
+
+class Stage:
+    def __init__(self, name, fn, workers=1, on_error=None, on_close=None, size=None, stats=None):
+        # fn(item) returns the item for the next stage, or None to drop it.
+        # on_close() may return leftover items to emit once the input is drained.
+        # size(item) is the number of images an item carries, 1 by default.
+        # stats() may return extra counters to log next to the stage's rate.
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.on_error = on_error
+        self.on_close = on_close
+        self.size = size
+        self.stats = stats
+
+        self.processed = 0
+        self.failed = 0
+        self.started_at = None
+        self._lock = threading.Lock()
+        self._running = workers
+
+    def rate(self):
+        if self.started_at is None:
+            return 0.0
+        return self.processed / max(time.perf_counter() - self.started_at, 1e-9)
+
+
+class Pipeline:
+    def __init__(self, stages, queue_size=100, log_interval=30):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.log_interval = log_interval
+        self._done = threading.Event()
+
+    def _work(self, stage, input_queue, output_queue):
+        while True:
+            item = input_queue.get()
+            if item is STOP:
+                break
+
+            with stage._lock:
+                if stage.started_at is None:
+                    stage.started_at = time.perf_counter()
+            try:
+                result = stage.fn(item)
+                with stage._lock:
+                    stage.processed += stage.size(item) if stage.size else 1
+                if result is not None and output_queue is not None:
+                    output_queue.put(result)
+            except Exception as ex:
+                with stage._lock:
+                    stage.failed += 1
+                logging.error(f"Error in stage {stage.name} for {item}: {ex}")
+                if stage.on_error is not None:
+                    try:
+                        stage.on_error(item, ex)
+                    except Exception as handler_ex:
+                        logging.error(f"Error handling failure of {item} in stage {stage.name}: {handler_ex}")
+
+        with stage._lock:
+            stage._running -= 1
+            last = stage._running == 0
+        if not last:
+            return
+
+        # The last worker of a stage flushes it and shuts the next stage down.
+        if stage.on_close is not None:
+            for result in stage.on_close() or []:
+                if output_queue is not None:
+                    output_queue.put(result)
+        if output_queue is not None:
+            next_stage = self.stages[self.stages.index(stage) + 1]
+            for _ in range(next_stage.workers):
+                output_queue.put(STOP)
+
+    def log_rates(self):
+        rates = ", ".join(f"{stage.name}: {stage.processed} done, {stage.failed} failed, "
+                          f"{stage.rate():.1f} images/sec" + (f" {stage.stats()}" if stage.stats else "")
+                          for stage in self.stages)
+        logging.info(f"Pipeline throughput - {rates}")
+
+    def _monitor(self):
+        while not self._done.wait(self.log_interval):
+            self.log_rates()
+
+    def run(self, items):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        threads = []
+        for i, stage in enumerate(self.stages):
+            output_queue = queues[i + 1] if i + 1 < len(queues) else None
+            for n in range(stage.workers):
+                thread = threading.Thread(target=self._work,
+                                          args=(stage, queues[i], output_queue),
+                                          name=f"{stage.name}-{n}",
+                                          daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        monitor = threading.Thread(target=self._monitor, daemon=True)
+        monitor.start()
+        try:
+            for item in items:
+                queues[0].put(item)
+        finally:
+            for _ in range(self.stages[0].workers):
+                queues[0].put(STOP)
+            for thread in threads:
+                thread.join()
+            self._done.set()
+            self.log_rates()
@@ -1,47 +1,42 @@
-import os
 import logging
 import json
 import google.cloud.logging
 from functools import partial
-from google.cloud import storage
-from PIL import Image as PILImage
+from blob_store import get_backend, with_retries
 from vertexai.preview.vision_models import MultiModalEmbeddingModel, Image
 
 
-def download_from_gcs(image_uri, data_bucket):
+def download_bytes_from_gcs(image_uri, data_bucket):
     try:
-        client = storage.Client()
-        bucket = client.bucket(data_bucket)
-        blob = bucket.blob(image_uri)
-        blob.download_to_filename(image_uri)
+        return with_retries(lambda: get_backend().download_bytes(data_bucket, image_uri))
     except Exception as ex:
         logging.error(f"Error downloading {image_uri} from GCS: {ex}")
+        raise
+
+
+def gcs_file_exists(bucket_name, gcs_path):
+    return with_retries(lambda: get_backend().exists(bucket_name, gcs_path))
 
 
 def list_gcs_files(data_bucket, prefix, allowed_extensions=['.jpg']):
+    return (image.name for image in list_gcs_images(data_bucket, prefix, allowed_extensions))
+
+
+def list_gcs_images(data_bucket, prefix, allowed_extensions=['.jpg'], page_size=1000):
     try:
-        client = storage.Client()
-        bucket = client.bucket(data_bucket)
-        files_list = [blob.name for blob in bucket.list_blobs(prefix=f"{prefix}/") 
-        if blob.name.lower().endswith(tuple(allowed_extensions))]
-        return files_list
+        for blob in get_backend().list(data_bucket, prefix=f"{prefix}/", page_size=page_size):
+            if blob.name.lower().endswith(tuple(allowed_extensions)):
+                yield blob
     except Exception as ex:
         logging.error(f"Error listing files in GCS: {ex}")
         raise
 
 
-def list_gcs_directories(data_bucket):
+def list_gcs_directories(data_bucket, prefix=''):
     try:
-        client = storage.Client()
-        bucket = client.bucket(data_bucket)
-        directories = set()
-        blobs = bucket.list_blobs()
-        for blob in blobs:
-            if blob.name == 'all/':
-                continue
-            directory = '/'.join(blob.name.split('/')[:-1])
-            directories.add(directory)
-        return list(directories)
+        prefix = f"{prefix.rstrip('/')}/" if prefix else None
+        for directory in get_backend().list_prefixes(data_bucket, prefix=prefix):
+            yield directory.rstrip('/')
     except Exception as ex:
         logging.error(f"Error listing directories in GCS: {ex}")
         raise
@@ -49,25 +44,24 @@ def list_gcs_directories(data_bucket):
 
 def upload_to_gcs(bucket_name, gcs_path, local_path):
     try:
-        client = storage.Client()
-        bucket = client.bucket(bucket_name)
-        blob = bucket.blob(gcs_path)
-        blob.upload_from_filename(local_path)
+        with_retries(lambda: get_backend().upload_file(bucket_name, gcs_path, local_path))
     except Exception as ex:
         logging.error(f"Error uploading {local_path} to GCS: {ex}")
         raise
 
 
-def resize_image(image_path):
+def upload_bytes_to_gcs(bucket_name, gcs_path, data, content_type="text/plain"):
     try:
-        with PILImage.open(image_path) as im:
-            im.thumbnail((1024, 1024), PILImage.LANCZOS)
-            im.save(image_path)
+        with_retries(lambda: get_backend().upload_bytes(bucket_name, gcs_path, data, content_type))
     except Exception as ex:
-        logging.error(f"Error resizing image {image_path}: {ex}")
+        logging.error(f"Error uploading {gcs_path} to GCS: {ex}")
         raise
 
 
-def is_file_empty(file_path):
-    file_size_bytes = os.path.getsize(file_path)
-    return file_size_bytes == 0
\ No newline at end of file
+def delete_from_gcs(bucket_name, gcs_path):
+    try:
+        if with_retries(lambda: get_backend().exists(bucket_name, gcs_path)):
+            with_retries(lambda: get_backend().delete(bucket_name, gcs_path))
+    except Exception as ex:
+        logging.error(f"Error deleting {gcs_path} from GCS: {ex}")
+
@@ -0,0 +1,13 @@
+import os
+
+COMPONENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(COMPONENT_DIR)))
+
+
+def test_app_copy_matches_the_pipeline_client():
+    # The app and the pipeline build from separate Docker contexts, so each tracks a copy
+    with open(os.path.join(COMPONENT_DIR, "src", "embedding_client.py")) as f:
+        pipeline_client = f.read()
+    with open(os.path.join(REPO_DIR, "app", "embedding_client.py")) as f:
+        app_client = f.read()
+    assert app_client == pipeline_client
@@ -0,0 +1,165 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from blob_store import BlobInfo, FilesystemBackend, set_backend
+from manifest import Manifest
+
+BUCKET = "vertex"
+MANIFEST_PATH = "manifest/manifest.db"
+
+
+@pytest.fixture
+def storage(tmp_path):
+    backend = FilesystemBackend(str(tmp_path / "buckets"))
+    set_backend(backend)
+    yield backend
+    set_backend(None)
+
+
+@pytest.fixture
+def manifest(storage, tmp_path):
+    return Manifest.load(BUCKET, MANIFEST_PATH, str(tmp_path / "manifest.db"))
+
+
+def image(name, generation=1, md5="md5-1"):
+    return BlobInfo(f"all/baroque/{name}.jpg", generation, md5)
+
+
+def test_load_without_manifest_starts_empty(manifest):
+    assert len(manifest) == 0
+    assert manifest.missing(set()) == []
+
+
+def test_save_and_load_round_trip(storage, manifest, tmp_path):
+    manifest.record([image("a"), image("b")], "batch_0.json", hashes=[1, 2])
+    manifest.save(BUCKET, MANIFEST_PATH)
+
+    loaded = Manifest.load(BUCKET, MANIFEST_PATH, str(tmp_path / "loaded.db"))
+    assert len(loaded) == 2
+    assert loaded.is_current(image("a"))
+    assert sorted(loaded.hashes()) == [("all/baroque/a.jpg", 1), ("all/baroque/b.jpg", 2)]
+
+
+def test_load_raises_when_download_fails(storage, tmp_path):
+    class BrokenBackend(FilesystemBackend):
+        def exists(self, bucket_name, name):
+            return True
+
+        def download_file(self, bucket_name, name, local_path):
+            raise FileNotFoundError(name)
+
+    set_backend(BrokenBackend(storage.root))
+    with pytest.raises(FileNotFoundError):
+        Manifest.load(BUCKET, MANIFEST_PATH, str(tmp_path / "manifest.db"))
+
+
+def test_save_waits_for_min_interval(storage, manifest):
+    manifest.record([image("a")], "batch_0.json")
+    manifest.save(BUCKET, MANIFEST_PATH, min_interval=60)
+    assert not storage.exists(BUCKET, MANIFEST_PATH)
+    manifest.save(BUCKET, MANIFEST_PATH)
+    assert storage.exists(BUCKET, MANIFEST_PATH)
+
+
+def test_is_current_compares_md5(manifest):
+    manifest.record([image("a", generation=1, md5="md5-1")], "batch_0.json")
+    assert manifest.is_current(image("a", generation=2, md5="md5-1"))
+    assert not manifest.is_current(image("a", generation=1, md5="md5-2"))
+    assert not manifest.is_current(image("b"))
+
+
+def test_is_current_falls_back_to_generation(manifest):
+    manifest.record([image("a", generation=1, md5=None)], "batch_0.json")
+    assert manifest.is_current(image("a", generation=1, md5=None))
+    assert not manifest.is_current(image("a", generation=2, md5=None))
+
+
+def test_missing_lists_images_no_longer_in_the_bucket(manifest):
+    manifest.record([image("a"), image("b"), image("c")], "batch_0.json")
+    assert manifest.missing({"all/baroque/a.jpg", "all/baroque/c.jpg"}) == ["all/baroque/b.jpg"]
+
+
+def test_delete_delta_leaves_out_duplicates(manifest):
+    # Only embedded images go to delta/delete/, a duplicate was never indexed
+    manifest.record([image("a")], "batch_0.json")
+    manifest.record_duplicate(image("a-copy"), "all/baroque/a.jpg")
+    manifest.record([image("b")], "batch_0.json")
+
+    deleted = manifest.missing({"all/baroque/a.jpg"})
+    indexed = [name for name in deleted if not manifest.is_duplicate(name)]
+    assert sorted(deleted) == ["all/baroque/a-copy.jpg", "all/baroque/b.jpg"]
+    assert indexed == ["all/baroque/b.jpg"]
+
+    manifest.remove(deleted)
+    assert len(manifest) == 1
+
+
+def test_duplicates_are_current_and_not_seeded(manifest):
+    manifest.record([image("a")], "batch_0.json", hashes=[7])
+    manifest.record_duplicate(image("a-copy"), "all/baroque/a.jpg")
+    assert manifest.is_current(image("a-copy"))
+    assert manifest.hashes() == [("all/baroque/a.jpg", 7)]
+
+
+def test_remove_orphan_duplicates(manifest):
+    manifest.record([image("a")], "batch_0.json")
+    manifest.record_duplicate(image("a-copy"), "all/baroque/a.jpg")
+    manifest.record_duplicate(image("gone-copy"), "all/baroque/gone.jpg")
+
+    assert manifest.remove_orphan_duplicates() == 1
+    assert manifest.is_duplicate("all/baroque/a-copy.jpg")
+    assert not manifest.is_current(image("gone-copy"))
+
+    # Once the canonical image is deleted its copies must be embedded themselves
+    manifest.remove(["all/baroque/a.jpg"])
+    assert manifest.remove_orphan_duplicates() == 1
+    assert len(manifest) == 0
+
+
+def test_stale_files_track_replaced_and_removed_rows(manifest):
+    manifest.record([image("a"), image("b")], "batch_0.json")
+    manifest.record([image("c")], "batch_1.json")
+    assert manifest.stale_files() == set()
+
+    manifest.record([image("a", md5="md5-2")], "batch_2.json")
+    manifest.remove(["all/baroque/c.jpg"])
+    assert manifest.stale_files() == {"batch_0.json", "batch_1.json"}
+    assert manifest.names_in("batch_0.json") == ["all/baroque/b.jpg"]
+    assert manifest.embedding_files() == {"batch_0.json", "batch_2.json"}
+
+    manifest.clear_stale()
+    assert manifest.stale_files() == set()
+
+
+def test_duplicates_mark_their_canonical_file_stale(manifest):
+    manifest.record([image("a"), image("b")], "batch_0.json")
+    manifest.record_duplicate(BlobInfo("all/realism/a-crop.jpg", 1, "md5-1"), "all/baroque/a.jpg")
+    assert manifest.duplicates_of(["all/baroque/a.jpg", "all/baroque/b.jpg"]) == {
+        "all/baroque/a.jpg": ["all/realism/a-crop.jpg"]}
+    assert manifest.stale_files() == {"batch_0.json"}
+
+    # Deleting the copy takes its genre away from the canonical image again
+    manifest.clear_stale()
+    manifest.remove(["all/realism/a-crop.jpg"])
+    assert manifest.duplicates_of(["all/baroque/a.jpg"]) == {}
+    assert manifest.stale_files() == {"batch_0.json"}
+
+
+def test_indexed_images_turned_duplicates_are_unindexed(manifest):
+    manifest.record([image("a"), image("b")], "batch_0.json")
+    manifest.record_duplicate(image("a", md5="md5-2"), "all/baroque/b.jpg")
+    manifest.record_duplicate(image("new-copy"), "all/baroque/b.jpg")
+    assert manifest.unindexed() == ["all/baroque/a.jpg"]
+    assert manifest.indexed_names() == ["all/baroque/b.jpg"]
+
+    # Edited again into an image of its own, it is embedded and must not be deleted
+    manifest.record([image("a", md5="md5-3")], "batch_1.json")
+    assert manifest.unindexed() == []
+
+    manifest.record_duplicate(image("a", md5="md5-2"), "all/baroque/b.jpg")
+    manifest.clear_unindexed()
+    assert manifest.unindexed() == []
@@ -10,9 +10,13 @@ def update_index(project_id: str,
                  vertex_bucket: str,
                  idx_prefix: str,
                  index_name: str,
-                 dimensions: int) -> str:
+                 dimensions: int,
+                 delta_prefix: str = "",
+                 approximate_neighbors_count: int = 150,
+                 leaf_node_embedding_count: int = 500,
+                 leaf_nodes_to_search_percent: int = 7) -> str:
 
-    from google.cloud import aiplatform
+    from google.cloud import aiplatform, storage
 
     aiplatform.init(project=project_id, location=location)
 
@@ -28,15 +32,27 @@ def update_index(project_id: str,
             location=location,
             contents_delta_uri=f"gs://{vertex_bucket}/{idx_prefix}/",
             dimensions=dimensions,
-            approximate_neighbors_count=150,
+            approximate_neighbors_count=approximate_neighbors_count,
             distance_measure_type="DOT_PRODUCT_DISTANCE",
-            leaf_node_embedding_count=500,
-            leaf_nodes_to_search_percent=7
+            leaf_node_embedding_count=leaf_node_embedding_count,
+            leaf_nodes_to_search_percent=leaf_nodes_to_search_percent
         )
         index_id = index.name
     else:
         index_id = index[0].name
         index = aiplatform.MatchingEngineIndex(index_name=index_id)
-        index.update_embeddings(f"gs://{vertex_bucket}/{idx_prefix}/")
+        if not delta_prefix:
+            # idx_prefix holds the whole corpus, so it replaces the index instead of adding to it
+            index.update_embeddings(f"gs://{vertex_bucket}/{idx_prefix}/", is_complete_overwrite=True)
+        else:
+            # Push only the upserts and deletes written since the last update
+            delta_blobs = list(storage.Client().bucket(vertex_bucket).list_blobs(prefix=f"{delta_prefix}/"))
+            if len(delta_blobs) > 0:
+                index.update_embeddings(f"gs://{vertex_bucket}/{delta_prefix}/")
+
+    # The delta has been applied, or is already contained in a newly created index
+    if delta_prefix:
+        for blob in storage.Client().bucket(vertex_bucket).list_blobs(prefix=f"{delta_prefix}/"):
+            blob.delete()
 
     return index_id
\ No newline at end of file
@@ -18,7 +18,11 @@ def generate_embeddings(
     vertex_bucket: str,
     all_prefix: str,
     idx_prefix: str,
-    fail_prefix: str):
+    fail_prefix: str,
+    manifest_path: str,
+    delta_prefix: str,
+    mode: str,
+    thumbnail_prefix: str):
 
   return dsl.ContainerSpec(
       image=os.getenv('DOCKER_IMAGE'),
@@ -30,7 +34,11 @@ def generate_embeddings(
         '--vertex_bucket', vertex_bucket,
         '--all_prefix', all_prefix,
         '--idx_prefix', idx_prefix,
-        '--fail_prefix', fail_prefix]
+        '--fail_prefix', fail_prefix,
+        '--manifest_path', manifest_path,
+        '--delta_prefix', delta_prefix,
+        '--mode', mode,
+        '--thumbnail_prefix', thumbnail_prefix]
   )
 
 @dsl.pipeline(
@@ -47,10 +55,17 @@ def pipeline(
     all_prefix: str,
     idx_prefix: str,
     fail_prefix: str,
+    manifest_path: str,
+    delta_prefix: str,
+    mode: str,
+    thumbnail_prefix: str,
     vertex_bucket: str,
     index_name: str,
     index_endpoint_name: str,
-    dimensions: int
+    dimensions: int,
+    approximate_neighbors_count: int,
+    leaf_node_embedding_count: int,
+    leaf_nodes_to_search_percent: int
 ):
 
     generate_embeddings_op = generate_embeddings(
@@ -60,7 +75,11 @@ def pipeline(
         vertex_bucket=vertex_bucket,
         all_prefix=all_prefix,
         idx_prefix=idx_prefix,
-        fail_prefix=fail_prefix)
+        fail_prefix=fail_prefix,
+        manifest_path=manifest_path,
+        delta_prefix=delta_prefix,
+        mode=mode,
+        thumbnail_prefix=thumbnail_prefix)
 
     update_index_op = update_index(
         project_id=project_id,
@@ -68,7 +87,11 @@ def pipeline(
         vertex_bucket=vertex_bucket,
         idx_prefix=idx_prefix,
         index_name=index_name,
-        dimensions=dimensions).after(generate_embeddings_op)
+        dimensions=dimensions,
+        delta_prefix=delta_prefix,
+        approximate_neighbors_count=approximate_neighbors_count,
+        leaf_node_embedding_count=leaf_node_embedding_count,
+        leaf_nodes_to_search_percent=leaf_nodes_to_search_percent).after(generate_embeddings_op)
 
     deploy_inedx_op = deploy_index(
         project_id=project_id,
@@ -103,9 +126,17 @@ if __name__ == '__main__':
             "all_prefix": os.getenv('ALL_PREFIX'),
             "idx_prefix": os.getenv('IDX_PREFIX'),
             "fail_prefix": os.getenv('FAIL_PREFIX'),
+            "manifest_path": os.getenv('MANIFEST_PATH', 'manifest/manifest.db'),
+            "delta_prefix": os.getenv('DELTA_PREFIX', 'delta'),
+            "mode": os.getenv('EMBEDDING_MODE', 'embed'),
+            "thumbnail_prefix": os.getenv('THUMBNAIL_PREFIX', 'thumbnails'),
             "index_name": os.getenv('INDEX_NAME'),
             "index_endpoint_name": os.getenv('INDEX_ENDPOINT_NAME'),
-            "dimensions": int(os.getenv('DIMENSIONS'))}
+            "dimensions": int(os.getenv('DIMENSIONS')),
+            # Tree-AH parameters, pick them with app/benchmarks/vector_index.py
+            "approximate_neighbors_count": int(os.getenv('APPROXIMATE_NEIGHBORS_COUNT', '150')),
+            "leaf_node_embedding_count": int(os.getenv('LEAF_NODE_EMBEDDING_COUNT', '500')),
+            "leaf_nodes_to_search_percent": int(os.getenv('LEAF_NODES_TO_SEARCH_PERCENT', '7'))}
     )
 
     job.run(service_account=os.getenv('SERVICE_ACCOUNT'))
\ No newline at end of file